@@ -18,7 +18,15 @@ import os
 import sys
 
 from bootstrap_vm.bootstrap import bootstrap_vm
+from bootstrap_vm.collect import gc_vm
+from bootstrap_vm.density import density_vm
+from bootstrap_vm.inventory import list_vm
+from bootstrap_vm.peers import share_vm
+from bootstrap_vm.prefetch import prefetch_vm
 from bootstrap_vm.remove import remove_vm
+from bootstrap_vm.reset import reset_vm
+from bootstrap_vm.run import run_vm
+from bootstrap_vm.seed_server import seed_vm
 
 
 def main():
@@ -31,8 +39,28 @@ def main():
         bootstrap_vm()
     elif filename == "remove-vm":
         remove_vm()
+    elif filename == "list-vm":
+        list_vm()
+    elif filename == "gc-vm":
+        gc_vm()
+    elif filename == "prefetch-vm":
+        prefetch_vm()
+    elif filename == "seed-vm":
+        seed_vm()
+    elif filename == "run-vm":
+        run_vm()
+    elif filename == "share-vm":
+        share_vm()
+    elif filename == "density-vm":
+        density_vm()
+    elif filename == "reset-vm":
+        reset_vm()
     else:
-        print("Filename should be bootstrap-vm or remove-vm", file=sys.stderr)
+        print(
+            "Filename should be bootstrap-vm, remove-vm, list-vm, gc-vm, prefetch-vm, "
+            "seed-vm, run-vm, share-vm, density-vm or reset-vm",
+            file=sys.stderr,
+        )
 
 
 if __name__ == "__main__":
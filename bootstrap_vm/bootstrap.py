@@ -21,11 +21,18 @@ import subprocess
 import sys
 import tempfile
 import time
-from shutil import copyfile
+import urllib.request
 
-from bootstrap_vm.distributions import Ubuntu
+from bootstrap_vm import metrics
+from bootstrap_vm.constants import ONE_DAY
+from bootstrap_vm.delta import block_map_url
+from bootstrap_vm.density import configure_ksm
+from bootstrap_vm.distributions import get_distribution
 from bootstrap_vm.file_utils import present
+from bootstrap_vm.inventory import Inventory
 from bootstrap_vm.remove import remove
+from bootstrap_vm.reset import create_snapshot
+from bootstrap_vm.task_graph import TaskGraph
 from bootstrap_vm.virtual_machine import VirtualMachine
 from bootstrap_vm.config import Config, default_config_file
 
@@ -45,73 +52,249 @@ def get_ip(name):
     return False
 
 
-def bootstrap(vm, args):
-    if not args["run"]:
-        vm.distribution.download(vm.image_location)
-        vm.distribution.verify(vm.image_location)
-
-    if not args["run"]:
-        copyfile(vm.image_location, vm.disk_location)
-        if args["disk"] != "2G":
-            subprocess.run(["qemu-img", "resize", vm.disk_location, args["disk"]])
+def copy_disk(vm, args):
+    # Base images can be sparse (with preallocated metadata), keep the holes
+    subprocess.run(
+        ["cp", "--sparse=always", vm.image_location, vm.disk_location], check=True
+    )
+    metrics.copied_bytes.inc(os.stat(vm.disk_location).st_blocks * 512)
+    if args["disk"] != "2G":
+        subprocess.run(["qemu-img", "resize", vm.disk_location, args["disk"]])
 
-    vm.generate_iso()
 
-    with tempfile.NamedTemporaryFile() as vm_def:
-        vm.generate_xml(vm_def.name)
-        subprocess.run(["virsh", "define", vm_def.name], check=True)
-        subprocess.run(["virsh", "create", vm_def.name], check=True)
+def define_domain(vm, xml_location):
+    subprocess.run(["virsh", "define", xml_location], check=True)
+    subprocess.run(["virsh", "create", xml_location], check=True)
     subprocess.run(["virsh", "autostart", vm.name], check=True)
 
+
+def check_seed(vm):
+    url = f"{vm.config.seed_url.rstrip('/')}/{vm.name}/meta-data"
+    try:
+        with urllib.request.urlopen(url, timeout=10):
+            pass
+    except OSError as e:
+        raise RuntimeError(
+            f"The seed data is not served at {url}, is seed-vm running? {e}"
+        )
+
+
+def wait_for_ip(vm, sleep=time.sleep):
     print("Waiting for IP address")
-    ip = False
-    if args["ip"]:
-        ip = args["ip"]
+    ip = get_ip(vm.name)
+    while not ip:
+        metrics.retries.inc(kind="ip")
+        sleep(1)
+        ip = get_ip(vm.name)
+    return ip
+
+
+def prepare_ssh(hostname, ip):
+    # A previous VM with the same name or address leaves a host key behind that
+    # would make ssh complain about a changed host identification
+    for host in [hostname, ip]:
+        subprocess.run(
+            ["ssh-keygen", "-f", "/root/.ssh/known_hosts", "-R", host],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+
+def install_packages(vm, ip, sleep=time.sleep):
+    print("Installing initial packages on the virtual machine")
+    returncode = 1
+    command = [
+        "ssh",
+        "-o",
+        "StrictHostKeyChecking=no",
+        f"{vm.distribution.user}@{ip}",
+        "--",
+        "sudo DEBIAN_FRONTEND=noninteractive apt-get -qy update &&"
+        " sudo DEBIAN_FRONTEND=noninteractivex "
+        f"apt-get install -qy {' '.join(config.initial_packages)}",
+    ]
+    while returncode != 0:
+        out = subprocess.run(command, stdin=sys.stdin, stderr=subprocess.PIPE)
+        returncode = out.returncode
+        if (
+            returncode != 0
+            and b"Connection refused" not in out.stderr
+            and b"No route to host" not in out.stderr
+        ):
+            print("Installing packages failed, error:", out.stderr)
+            print("Maybe you can run the command manually:")
+            print()
+            print(
+                "sudo " + " ".join(f'"{sub}"' if " " in sub else sub for sub in command)
+            )
+            print()
+            break
+        if returncode != 0:
+            metrics.retries.inc(kind="ssh")
+        sleep(1)
+
+
+def wait_until_ready(vm, ip, sleep=time.sleep, timeout=600):
+    """Wait until cloud-init is done, so a snapshot captures the finished vm"""
+    print("Waiting for cloud-init to finish")
+    command = [
+        "ssh",
+        "-o",
+        "StrictHostKeyChecking=no",
+        # Never prompt for a password, the keys might not be installed yet
+        "-o",
+        "BatchMode=yes",
+        f"{vm.distribution.user}@{ip}",
+        "--",
+        "cloud-init status --wait",
+    ]
+    deadline = time.monotonic() + timeout
+    while True:
+        out = subprocess.run(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        # cloud-init exits with 2 when it finished with recoverable errors
+        if out.returncode in (0, 2):
+            return
+        # ssh exits with 255 when it could not connect or log in, which is normal
+        # while the vm is booting
+        if out.returncode != 255:
+            raise RuntimeError(f"cloud-init did not finish successfully: {out.stderr}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Could not connect to {ip} with ssh: {out.stderr}")
+        metrics.retries.inc(kind="ssh")
+        sleep(1)
+
+
+def bootstrap(vm, args):
+    # The stages below form a dependency graph, independent stages (like downloading
+    # the image and generating the cloud-init iso) are run at the same time
+    graph = TaskGraph(disk_path=config.images_path)
+    results = graph.results
 
     hostname = f"{vm.name}.{config.domain}"
     if args["hostname"]:
         hostname = args["hostname"]
 
-    while not ip:
-        ip = get_ip(vm.name)
-        time.sleep(1)
-
-    print(f"The address for {hostname} is {ip}")
-    if not args["hostname"]:
-        print(f"Putting {hostname} in /etc/hosts")
-        present("/etc/hosts", hostname + "$", f"{ip} {hostname}")
-
-    if not args["no_install"]:
-        print("Installing initial packages on the virtual machine")
-        returncode = 1
-        command = [
-            "ssh",
-            "-o",
-            "StrictHostKeyChecking=no",
-            f"ubuntu@{ip}",
-            "--",
-            "sudo DEBIAN_FRONTEND=noninteractive apt-get -qy update &&"
-            " sudo DEBIAN_FRONTEND=noninteractivex "
-            f"apt-get install -qy {' '.join(config.initial_packages)}",
-        ]
-        while returncode != 0:
-            out = subprocess.run(command, stdin=sys.stdin, stderr=subprocess.PIPE)
-            returncode = out.returncode
-            if (
-                returncode != 0
-                and b"Connection refused" not in out.stderr
-                and b"No route to host" not in out.stderr
-            ):
-                print("Installing packages failed, error:", out.stderr)
-                print("Maybe you can run the command manually:")
-                print()
-                print(
-                    "sudo "
-                    + " ".join(f'"{sub}"' if " " in sub else sub for sub in command)
-                )
-                print()
-                break
-            time.sleep(1)
+    inventory = Inventory(config.inventory)
+    inventory.add(vm, hostname=hostname, profile=args["static"], labels=args["labels"])
+
+    define_requires = ["generate_xml"]
+    distribution = vm.distribution
+    # When prefetch-vm keeps the cache up to date, never download on the request path
+    max_age = None if config.prefetch else ONE_DAY
+    if not args["run"] and distribution.needs_download(vm.image_location, max_age):
+        # Peers share images by checksum, so the checksums are needed first
+        graph.add("fetch_checksums", distribution.fetch_checksums)
+        graph.add(
+            "download",
+            lambda: distribution.download(
+                vm.image_location,
+                block_map_url(config, distribution.image_url()),
+                config.delta_rolling,
+                config.peers,
+                (
+                    distribution.expected_checksum(results["fetch_checksums"])
+                    if config.peers
+                    else None
+                ),
+            ),
+            requires=["fetch_checksums"] if config.peers else (),
+        )
+        graph.add(
+            "verify",
+            lambda: distribution.verify(
+                results["download"], results["fetch_checksums"]
+            ),
+            requires=["download", "fetch_checksums"],
+        )
+        graph.add(
+            "prepare_image",
+            lambda: distribution.install(
+                results["download"], vm.image_location, results["verify"]
+            ),
+            requires=["verify"],
+        )
+        graph.add("copy_disk", lambda: copy_disk(vm, args), requires=["prepare_image"])
+        define_requires.append("copy_disk")
+    elif not args["run"]:
+        graph.add("copy_disk", lambda: copy_disk(vm, args))
+        define_requires.append("copy_disk")
+
+    with tempfile.NamedTemporaryFile() as vm_def:
+        if args["seed"] == "http":
+            graph.add("check_seed", lambda: check_seed(vm))
+            define_requires.append("check_seed")
+        else:
+            graph.add("generate_iso", vm.generate_iso)
+            define_requires.append("generate_iso")
+        graph.add("generate_xml", lambda: vm.generate_xml(vm_def.name))
+        if args["density"]:
+            graph.add("ksm", lambda: configure_ksm(config))
+        graph.add(
+            "define", lambda: define_domain(vm, vm_def.name), requires=define_requires
+        )
+
+        if args["ip"]:
+            graph.add("ip", lambda: args["ip"])
+        else:
+            graph.add("ip", lambda: wait_for_ip(vm, graph.sleep), requires=["define"])
+
+        if not args["hostname"]:
+
+            def update_hosts():
+                print(f"Putting {hostname} in /etc/hosts")
+                present("/etc/hosts", hostname + "$", f"{results['ip']} {hostname}")
+
+            graph.add("hosts", update_hosts, requires=["ip"])
+
+        graph.add(
+            "inventory",
+            lambda: inventory.update(vm.name, ip=results["ip"]),
+            requires=["ip"],
+        )
+        graph.add(
+            "ssh_prep", lambda: prepare_ssh(hostname, results["ip"]), requires=["ip"]
+        )
+        if not args["no_install"]:
+            graph.add(
+                "install",
+                lambda: install_packages(vm, results["ip"], graph.sleep),
+                requires=["define", "ip", "ssh_prep"],
+            )
+        if args["snapshot"]:
+            graph.add(
+                "ready",
+                lambda: wait_until_ready(vm, results["ip"], graph.sleep),
+                requires=["define", "ip", "ssh_prep"],
+            )
+            graph.add(
+                "snapshot",
+                lambda: create_snapshot(vm.name),
+                requires=["ready"] if args["no_install"] else ["ready", "install"],
+            )
+
+        try:
+            graph.run()
+        finally:
+            if "download" in results:
+                distribution.discard(results["download"])
+
+    for stage in graph.stages.values():
+        metrics.stage_duration.observe(
+            stage.duration, operation="create", stage=stage.name
+        )
+        metrics.stage_disk_usage.observe(
+            stage.disk_usage, operation="create", stage=stage.name
+        )
+    metrics.operation_duration.observe(graph.end - graph.start, operation="create")
+
+    print(f"The address for {hostname} is {results['ip']}")
+    graph.print_critical_path()
+    graph.print_disk_usage()
 
     print(
         "You can run the following command (on your local machine, only needed once) "
@@ -122,13 +305,16 @@ def bootstrap(vm, args):
         f'echo -e "Host *.{config.domain}\\n\\tProxyCommand ssh {socket.getfqdn()} nc %h %p" >> ~/.ssh/config'
     )
     print()
-    print("You have access to the (sudo enabled) user `ubuntu` by default")
+    print(
+        f"You have access to the (sudo enabled) user `{vm.distribution.user}` by default"
+    )
 
 
 def bootstrap_vm():
     parser = argparse.ArgumentParser(
         description="Bootstrap a VM using virt-install and ansible"
     )
+    parser.add_argument("--distribution", help="the distribution to use")
     parser.add_argument("--variant", help="the distribution variant to use")
     parser.add_argument(
         "-r", "--run", action="store_true", help="start an existing disk"
@@ -139,8 +325,23 @@ def bootstrap_vm():
     parser.add_argument("--ip", help="ip to use for static network")
     parser.add_argument("--hostname", help="hostname to use for static network")
     parser.add_argument("--netplan", help="netplan config to use")
+    parser.add_argument(
+        "--seed",
+        choices=["iso", "http"],
+        help="provide the cloud-init seed with an iso or from seed-vm",
+    )
     parser.add_argument("--vcpu", type=int, help="amount of VCPUs")
     parser.add_argument("--memory", type=int, help="amount of memory")
+    parser.add_argument(
+        "--density",
+        action="store_true",
+        help="add a memory balloon with free page reporting and enable KSM",
+    )
+    parser.add_argument(
+        "--current-memory",
+        type=int,
+        help="amount of memory to start with in density mode (up to --memory)",
+    )
     parser.add_argument(
         "--disk", help="disk size (use format that qemu-img understands)"
     )
@@ -155,6 +356,18 @@ def bootstrap_vm():
         dest="public_keys",
         help="add this public key to the authorized_keys on the created VM",
     )
+    parser.add_argument(
+        "-l",
+        "--label",
+        action="append",
+        dest="labels",
+        help="add this label to the VM in the inventory, used to select VMs in run-vm",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="take a snapshot when the VM is ready, so it can be reset with reset-vm",
+    )
     parser.add_argument(
         "--no-clean",
         action="store_true",
@@ -179,7 +392,9 @@ def bootstrap_vm():
     variant = args["variant"]
 
     try:
-        args["distribution"] = Ubuntu(variant)
+        args["distribution"] = get_distribution(
+            args["distribution"] or config.distribution, variant, config
+        )
     except RuntimeError as e:
         print(e, file=sys.stderr)
         sys.exit(1)
@@ -197,17 +412,33 @@ def bootstrap_vm():
             or config.get("netplan")
             or None
         )
+        args["seed"] = args["seed"] or config.static[static].get("seed") or config.seed
         args["vcpu"] = args["vcpu"] or config.static[static].get("vcpu") or config.vcpu
         args["memory"] = (
             args["memory"] or config.static[static].get("memory") or config.memory
         )
+        args["density"] = (
+            args["density"] or config.static[static].get("density") or config.density
+        )
+        args["current_memory"] = (
+            args["current_memory"]
+            or config.static[static].get("current_memory")
+            or config.current_memory
+        )
         args["disk"] = args["disk"] or config.static[static].get("disk") or config.disk
+        args["snapshot"] = (
+            args["snapshot"] or config.static[static].get("snapshot") or config.snapshot
+        )
         args["host_keys"] = (
             args["host_keys"]
             or config.static[static].get("host_keys")
             or config.get("host_keys")
             or None
         )
+        args["labels"] = {
+            *(config.static[static].get("labels") or []),
+            *(args["labels"] or []),
+        }
         args["public_keys"] = {
             *(config.static[static].get("public_keys") or []),
             *(config.get("public_keys") or []),
@@ -215,15 +446,24 @@ def bootstrap_vm():
         }
     else:
         args["netplan"] = args["netplan"] or config.get("netplan") or None
+        args["seed"] = args["seed"] or config.seed
         args["vcpu"] = args["vcpu"] or config.vcpu
         args["memory"] = args["memory"] or config.memory
+        args["density"] = args["density"] or config.density
+        args["current_memory"] = args["current_memory"] or config.current_memory
         args["disk"] = args["disk"] or config.disk
+        args["snapshot"] = args["snapshot"] or config.snapshot
         args["host_keys"] = args["host_keys"] or config.get("host_keys") or None
+        args["labels"] = set(args["labels"] or [])
         args["public_keys"] = {
             *(config.get("public_keys") or []),
             *(args["public_keys"] or []),
         }
 
+    if args["density"] and (args["current_memory"] or 0) > args["memory"]:
+        print("The current memory cannot be more than the memory", file=sys.stderr)
+        sys.exit(1)
+
     del args["config"]
     vm = VirtualMachine(config=config, **args)
 
@@ -231,6 +471,8 @@ def bootstrap_vm():
         print(f"The virtual machine {name} already exists", file=sys.stderr)
         sys.exit(1)
 
+    metrics.in_flight.inc()
+    metrics.flush(config)
     try:
         bootstrap(vm, args)
     except (Exception, KeyboardInterrupt) as e:
@@ -240,3 +482,6 @@ def bootstrap_vm():
         remove(name, config, confirm=False)
         if not isinstance(e, KeyboardInterrupt):
             raise e
+    finally:
+        metrics.in_flight.dec()
+        metrics.flush(config)
@@ -0,0 +1,271 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bootstrap_vm.config import Config, default_config_file
+from bootstrap_vm.distributions import Distribution, all_variants, registry
+from bootstrap_vm.file_utils import absent, human_size
+from bootstrap_vm.inventory import Inventory
+
+CATEGORIES = ["disks", "isos", "downloads", "base images", "hosts", "inventory"]
+
+
+class Garbage:
+    def __init__(self, category, description, size, delete):
+        self.category = category
+        self.description = description
+        self.size = size
+        self.delete = delete
+
+
+def allocated_size(entry):
+    # Disk images are often sparse, so count the blocks that are actually used
+    return entry.stat().st_blocks * 512
+
+
+def list_domains():
+    out = subprocess.run(
+        ["virsh", "list", "--all", "--name"], stdout=subprocess.PIPE, check=True
+    )
+    return {line for line in str(out.stdout, encoding="utf-8").split() if line}
+
+
+def domain_disks(domain):
+    out = subprocess.run(["virsh", "domblklist", domain], stdout=subprocess.PIPE)
+    sources = set()
+    for line in str(out.stdout, encoding="utf-8").split("\n")[2:]:
+        words = line.split(None, 1)
+        if len(words) == 2 and words[1].strip() != "-":
+            sources.add(os.path.realpath(words[1].strip()))
+    return sources
+
+
+def backing_chain(disk):
+    out = subprocess.run(
+        ["qemu-img", "info", "--force-share", "--backing-chain", "--output=json", disk],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if out.returncode != 0:
+        return set()
+    return {os.path.realpath(image["filename"]) for image in json.loads(out.stdout)}
+
+
+def scan(path, suffix):
+    if not os.path.isdir(path):
+        return []
+    return [entry for entry in os.scandir(path) if entry.name.endswith(suffix)]
+
+
+def base_images(config):
+    """Locations of the cached base images for every known distribution variant"""
+    return {
+        Distribution(key, variant, config).cache_location(config.images_path)
+        for key, variant in all_variants(config)
+    }
+
+
+def collect(config, grace):
+    """
+    Collect the state of the domains, image directories, /etc/hosts and inventory
+    and return everything that is not in use anymore.
+    """
+    inventory = Inventory(config.inventory)
+    domains = list_domains()
+    records = {record["name"]: record for record in inventory.find()}
+
+    # VMs that are in the inventory without a domain might still be bootstrapping
+    in_flight = {
+        name
+        for name, record in records.items()
+        if name not in domains and record["created_at"] > time.time() - grace
+    }
+    live = domains | in_flight
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        used = set()
+        for disks in executor.map(domain_disks, domains):
+            used |= disks
+        for chain in executor.map(
+            backing_chain, [d for d in used if os.path.isfile(d)]
+        ):
+            used |= chain
+
+    def remove_file(entry):
+        def remove():
+            os.remove(entry.path)
+            # Cached base images have their metadata next to them
+            if os.path.isfile(entry.path + ".json"):
+                os.remove(entry.path + ".json")
+
+        return remove
+
+    known_images = base_images(config)
+    distribution_names = {value["name"] for value in registry(config).values()}
+
+    garbage = []
+    disk_names = set()
+    for entry in scan(config.images_path, ".img"):
+        name = entry.name[: -len(".img")]
+        if os.path.realpath(entry.path) in used or name in live:
+            continue
+        if entry.path in known_images:
+            continue
+        if name.split("-", 1)[0] in distribution_names:
+            category = "base images"
+        else:
+            category = "disks"
+            disk_names.add(name)
+        garbage.append(
+            Garbage(category, entry.path, allocated_size(entry), remove_file(entry))
+        )
+
+    # The previous downloads are needed for delta refreshes and share-vm
+    seeds = set()
+    if config.delta or config.keep_downloads:
+        for key, variant in all_variants(config):
+            distribution = Distribution(key, variant, config)
+            image_location = distribution.cache_location(config.images_path)
+            seeds.add(distribution.seed_location(image_location))
+
+    downloads = scan(config.images_path, ".raw") + scan(config.images_path, ".part")
+    for entry in downloads:
+        # A recent download might still be in progress
+        if entry.stat().st_mtime > time.time() - grace or entry.path in seeds:
+            continue
+        garbage.append(
+            Garbage("downloads", entry.path, allocated_size(entry), remove_file(entry))
+        )
+
+    # Like seed isos, only the /etc/hosts entries of VMs we know about are collected,
+    # other entries in the domain might have been added by hand
+    hostnames = {record["hostname"] for record in records.values()}
+    hosts = set()
+    with open("/etc/hosts") as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 2 and words[1].endswith("." + config.domain):
+                name = words[1][: -len(config.domain) - 1]
+                known_host = (
+                    name in records or name in disk_names or words[1] in hostnames
+                )
+                if name not in live and known_host:
+                    hosts.add(name)
+                    garbage.append(
+                        Garbage(
+                            "hosts",
+                            line.strip(),
+                            len(line),
+                            lambda hostname=words[1]: absent(
+                                "/etc/hosts", r"\s" + re.escape(hostname) + "$"
+                            ),
+                        )
+                    )
+
+    # Only seed isos that belong to a VM we know about are collected, iso_path
+    # usually contains installation media as well
+    known = set(records) | disk_names | hosts
+    for entry in scan(config.iso_path, ".iso"):
+        name = entry.name[: -len(".iso")]
+        if os.path.realpath(entry.path) in used or name in live or name not in known:
+            continue
+        garbage.append(
+            Garbage("isos", entry.path, allocated_size(entry), remove_file(entry))
+        )
+
+    for name in records:
+        if name not in live:
+            garbage.append(
+                Garbage("inventory", name, 0, lambda name=name: inventory.remove(name))
+            )
+
+    return garbage
+
+
+def delete(item):
+    try:
+        item.delete()
+    except OSError as e:
+        return e
+    return None
+
+
+def gc_vm():
+    parser = argparse.ArgumentParser(
+        description="Remove disks, isos and other files left behind by failed runs"
+    )
+    parser.add_argument("-c", "--config", help="config file to use")
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="only show what would be removed",
+    )
+    parser.add_argument(
+        "-y", "--yes", action="store_true", help="do not ask for confirmation"
+    )
+    parser.add_argument(
+        "--grace",
+        type=int,
+        default=60 * 60,
+        help="seconds after which an inventory entry without a domain is stale",
+    )
+
+    args = vars(parser.parse_args())
+
+    if args["config"]:
+        config = Config(args["config"])
+    else:
+        config = Config(default_config_file())
+
+    garbage = collect(config, args["grace"])
+    if not garbage:
+        print("Nothing to clean up")
+        return
+
+    for category in CATEGORIES:
+        items = [item for item in garbage if item.category == category]
+        if not items:
+            continue
+        total = sum(item.size for item in items)
+        print(f"{category}: {len(items)} items, {human_size(total)}")
+        for item in items:
+            print(f"  {item.description}")
+    print(f"Total: {human_size(sum(item.size for item in garbage))}")
+
+    if args["dry_run"]:
+        return
+    if not args["yes"] and input("Do you want to remove these? [y/N] ") != "y":
+        return
+
+    files = [item for item in garbage if item.category not in ("hosts", "inventory")]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for item, error in zip(files, executor.map(delete, files)):
+            if error:
+                print(f"Could not remove {item.description}: {error}", file=sys.stderr)
+    # Every hosts entry rewrites /etc/hosts, so these are not done in parallel
+    for item in garbage:
+        if item.category in ("hosts", "inventory"):
+            item.delete()
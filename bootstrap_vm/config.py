@@ -18,7 +18,7 @@ import os
 
 import yaml
 
-from bootstrap_vm.constants import APP_NAME
+from bootstrap_vm.constants import APP_NAME, ONE_DAY
 
 DEFAULT_CONFIG = {
     "initial_packages": [
@@ -27,13 +27,42 @@ DEFAULT_CONFIG = {
         "python-apt",
         "python-simplejson",
     ],
+    "distribution": "ubuntu",
+    "mirrors": {},
+    "mirror_cache": "/var/lib/bootstrap-vm/mirrors.json",
+    "mirror_ttl": ONE_DAY,
+    "seed": "iso",
+    "seed_address": "192.168.122.1",
+    "seed_port": 8780,
+    "seed_url": "http://192.168.122.1:8780/",
+    "peers": [],
+    "share_address": "0.0.0.0",
+    "share_port": 8781,
     "vcpu": 1,
     "memory": 1048576,
+    "snapshot": False,
+    "density": False,
+    "current_memory": None,
+    "ksm": {"run": 1},
+    "ksm_root": "/sys/kernel/mm/ksm",
     "disk": "2G",
     "domain": "test",
     "base_path": "/var/lib/libvirt/",
     "iso_path": "/var/lib/libvirt/iso",
     "images_path": "/var/lib/libvirt/images",
+    "inventory": "/var/lib/bootstrap-vm/inventory.db",
+    "prefetch": False,
+    "prefetch_variants": None,
+    "prefetch_interval": None,
+    "delta": False,
+    "delta_rolling": False,
+    "keep_downloads": False,
+    "image_cluster_size": "64k",
+    "image_preallocation": "metadata",
+    "image_compress": False,
+    "block_map_url": "{url}.blockmap",
+    "metrics_textfile": None,
+    "metrics_port": None,
 }
 
 
@@ -27,12 +27,14 @@ VM_XML = """
     </libosinfo:libosinfo>
   </metadata>
   <memory>{memory}</memory>
-  <currentMemory>{memory}</currentMemory>
+  <currentMemory>{current_memory}</currentMemory>
   <vcpu>{vcpu}</vcpu>
   <os>
     <type arch="x86_64" machine="pc-i440fx-bionic">hvm</type>
     <boot dev="hd"/>
+    {smbios}
   </os>
+  {sysinfo}
   <features>
     <acpi/>
     <apic/>
@@ -54,12 +56,7 @@ VM_XML = """
       <source file="{disk_location}"/>
       <target dev="vda" bus="virtio"/>
     </disk>
-    <disk type="file" device="cdrom">
-      <driver name="qemu" type="raw"/>
-      <source file="{iso_location}"/>
-      <target dev="hda" bus="ide"/>
-      <readonly/>
-    </disk>
+    {seed}
     <controller type="usb" index="0" model="ich9-ehci1"/>
     <controller type="usb" index="0" model="ich9-uhci1">
       <master startport="0"/>
@@ -81,9 +78,32 @@ VM_XML = """
     <rng model="virtio">
       <backend model="random">/dev/urandom</backend>
     </rng>
+    {memballoon}
   </devices>
 </domain>"""
 
+ISO_SEED = """
+<disk type="file" device="cdrom">
+  <driver name="qemu" type="raw"/>
+  <source file="{iso_location}"/>
+  <target dev="hda" bus="ide"/>
+  <readonly/>
+</disk>"""
+
+SMBIOS_SEED = """
+<sysinfo type="smbios">
+  <system>
+    <entry name="serial">ds=nocloud-net;s={seed_url}</entry>
+  </system>
+</sysinfo>"""
+
+# The balloon returns the pages the guest frees to the host, and gives memory back
+# to the guest (up to the maximum) when it runs out
+MEMBALLOON = """
+<memballoon model="virtio" autodeflate="on" freePageReporting="on">
+  <stats period="10"/>
+</memballoon>"""
+
 DHCP_INTERFACE = """
 <interface type="network">
   <mac address="{macaddress}"/>
@@ -0,0 +1,215 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Delta refresh of images, in the style of zsync: the new image is described by a
+# block map with a weak (rolling) and a strong checksum for every block. Blocks
+# that can be found in a previous image are copied from it, only the other
+# blocks are fetched with HTTP range requests.
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+
+BLOCK_SIZE = 64 * 1024
+
+
+class DeltaUnavailable(Exception):
+    pass
+
+
+def weak_checksum(block):
+    """The rsync rolling checksum, returns the a and b halves"""
+    # b is the sum of (length - index) * byte, which is the sum of the prefix sums
+    return sum(block) & 0xFFFF, sum(accumulate(block)) & 0xFFFF
+
+
+def strong_checksum(block):
+    return hashlib.sha256(block).hexdigest()[:32]
+
+
+def make_block_map(path, block_size=BLOCK_SIZE):
+    """Create the block map of a file, for a cache that serves delta refreshes"""
+    blocks = []
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            file_hash.update(block)
+            a, b = weak_checksum(block)
+            blocks.append([(b << 16) | a, strong_checksum(block)])
+    return {
+        "version": 1,
+        "block_size": block_size,
+        "length": os.path.getsize(path),
+        "sha256": file_hash.hexdigest(),
+        "blocks": blocks,
+    }
+
+
+def fetch_block_map(url):
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            block_map = json.load(response)
+    except (OSError, ValueError) as e:
+        raise DeltaUnavailable(f"No block map at {url}: {e}")
+    if block_map.get("version") != 1:
+        raise DeltaUnavailable(f"Unsupported block map version at {url}")
+    return block_map
+
+
+def match_blocks(seed, block_map, rolling=False):
+    """
+    Find the blocks of the new image in the seed, returns a dict from block number
+    to offset in the seed. Blocks are first looked up at block aligned offsets,
+    which finds everything that did not move. The rolling search also finds blocks
+    at other offsets but checks every byte, so it is a lot slower in Python.
+    """
+    block_size = block_map["block_size"]
+    strong = {}
+    weak = {}
+    for number, (weak_sum, strong_sum) in enumerate(block_map["blocks"]):
+        # A short last block is always fetched
+        if (number + 1) * block_size > block_map["length"]:
+            continue
+        strong.setdefault(strong_sum, []).append(number)
+        weak.setdefault(weak_sum, []).append(number)
+
+    found = {}
+
+    def add(checksum, offset):
+        for number in strong.pop(checksum, []):
+            found[number] = offset
+
+    for offset in range(0, len(seed) - block_size + 1, block_size):
+        checksum = strong_checksum(seed[offset : offset + block_size])
+        add(checksum, offset)
+
+    if not rolling or not strong:
+        return found
+
+    offset = 0
+    a, b = weak_checksum(seed[:block_size])
+    while offset + block_size <= len(seed):
+        if (b << 16) | a in weak:
+            checksum = strong_checksum(seed[offset : offset + block_size])
+            if checksum in strong:
+                add(checksum, offset)
+                offset += block_size
+                a, b = weak_checksum(seed[offset : offset + block_size])
+                continue
+        if offset + block_size < len(seed):
+            removed, added = seed[offset], seed[offset + block_size]
+            a = (a - removed + added) & 0xFFFF
+            b = (b - block_size * removed + a) & 0xFFFF
+        offset += 1
+    return found
+
+
+def missing_ranges(block_map, found):
+    """Coalesce the blocks that were not found into (start, end) byte ranges"""
+    block_size = block_map["block_size"]
+    ranges = []
+    for number in range(len(block_map["blocks"])):
+        if number in found:
+            continue
+        start = number * block_size
+        end = min(start + block_size, block_map["length"])
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def fetch_range(url, start, end, output):
+    request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end - 1}"})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        if response.status != 206:
+            raise DeltaUnavailable(f"{url} does not support range requests")
+        with open(output, "r+b") as f:
+            f.seek(start)
+            position = start
+            for chunk in iter(lambda: response.read(1024 * 1024), b""):
+                f.write(chunk)
+                position += len(chunk)
+    if position != end:
+        raise DeltaUnavailable(f"Short range response from {url}")
+    return end - start
+
+
+def delta_download(url, block_map_url, seed_location, output, rolling=False):
+    """
+    Rebuild the image at url in output, using seed_location as the previous
+    version. Returns the number of bytes that were fetched and the number of bytes
+    that were reused from the seed.
+    """
+    block_map = fetch_block_map(block_map_url)
+    block_size = block_map["block_size"]
+    if os.path.getsize(seed_location) == 0:
+        raise DeltaUnavailable(f"{seed_location} is empty")
+
+    with open(seed_location, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as seed:
+        found = match_blocks(seed, block_map, rolling)
+        with open(output, "wb") as out:
+            out.truncate(block_map["length"])
+            for number, offset in sorted(found.items()):
+                out.seek(number * block_size)
+                out.write(seed[offset : offset + block_size])
+
+    ranges = missing_ranges(block_map, found)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        fetched = sum(
+            executor.map(lambda r: fetch_range(url, r[0], r[1], output), ranges)
+        )
+
+    file_hash = hashlib.sha256()
+    with open(output, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    if file_hash.hexdigest() != block_map["sha256"]:
+        raise DeltaUnavailable("The rebuilt image does not match the block map")
+    return fetched, block_map["length"] - fetched
+
+
+def block_map_url(config, url):
+    """The block map for the image at url, or None if delta refreshes are disabled"""
+    if not config.delta:
+        return None
+    return config.block_map_url.format(url=url, filename=url.split("/")[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create a block map for delta refreshes of an image"
+    )
+    parser.add_argument("image", help="the image to create the block map for")
+    parser.add_argument("-o", "--output", help="defaults to IMAGE.blockmap")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+
+    with open(args.output or args.image + ".blockmap", "w") as f:
+        json.dump(make_block_map(args.image, args.block_size), f)
+
+
+if __name__ == "__main__":
+    main()
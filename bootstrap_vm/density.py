@@ -0,0 +1,176 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import os
+import subprocess
+import sys
+
+from bootstrap_vm.config import Config, default_config_file
+from bootstrap_vm.file_utils import human_size
+from bootstrap_vm.inventory import Inventory
+
+KSM_STATS = ["pages_shared", "pages_sharing", "pages_unshared", "pages_volatile"]
+
+
+class KSM:
+    """The kernel samepage merging settings and statistics in sysfs"""
+
+    def __init__(self, root="/sys/kernel/mm/ksm"):
+        self.root = root
+
+    def available(self):
+        return os.path.isfile(os.path.join(self.root, "run"))
+
+    def read(self, name):
+        with open(os.path.join(self.root, name)) as f:
+            return int(f.read().strip())
+
+    def write(self, name, value):
+        with open(os.path.join(self.root, name), "w") as f:
+            f.write(f"{int(value)}\n")
+
+    def configure(self, settings):
+        """Apply the settings that differ from the current ones, returns those"""
+        changed = {}
+        for name, value in settings.items():
+            if self.read(name) != int(value):
+                self.write(name, value)
+                changed[name] = int(value)
+        return changed
+
+    def stats(self):
+        return {
+            name: self.read(name)
+            for name in KSM_STATS
+            if os.path.isfile(os.path.join(self.root, name))
+        }
+
+    def saved_bytes(self):
+        """Every page in pages_sharing is a page that is not used twice"""
+        return self.read("pages_sharing") * os.sysconf("SC_PAGE_SIZE")
+
+
+def configure_ksm(config):
+    """Apply the ksm settings from the config, a host without KSM is skipped"""
+    ksm = KSM(config.ksm_root)
+    if not ksm.available():
+        print(f"KSM is not available ({config.ksm_root} does not exist)")
+        return {}
+    try:
+        changed = ksm.configure(config.ksm)
+    except OSError as e:
+        print(f"Could not configure KSM: {e}", file=sys.stderr)
+        return {}
+    for name, value in changed.items():
+        print(f"Set KSM {name} to {value}")
+    return changed
+
+
+def parse_key_values(output):
+    """Parse the `key value` or `Key: value KiB` lines printed by virsh"""
+    values = {}
+    for line in output.splitlines():
+        if ":" in line:
+            key, _, value = line.partition(":")
+        else:
+            key, _, value = line.partition(" ")
+        words = value.split()
+        if key and words and words[0].isdigit():
+            values[key.strip().lower()] = int(words[0])
+    return values
+
+
+def memory_stats(domain):
+    """
+    The maximum memory, the current balloon size and the resident memory of a
+    domain in KiB, or None if the domain is not running
+    """
+    dommemstat = subprocess.run(
+        ["virsh", "dommemstat", domain],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    dominfo = subprocess.run(
+        ["virsh", "dominfo", domain], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    if dommemstat.returncode != 0 or dominfo.returncode != 0:
+        return None
+    stats = parse_key_values(str(dommemstat.stdout, encoding="utf-8"))
+    info = parse_key_values(str(dominfo.stdout, encoding="utf-8"))
+    if "actual" not in stats or "max memory" not in info:
+        return None
+    return {
+        "maximum": info["max memory"],
+        "actual": stats["actual"],
+        "rss": stats.get("rss", stats["actual"]),
+    }
+
+
+def density_vm():
+    parser = argparse.ArgumentParser(
+        description="Report how much memory ballooning and KSM reclaim from the vms"
+    )
+    parser.add_argument("-c", "--config", help="config file to use")
+    parser.add_argument(
+        "--configure",
+        action="store_true",
+        help="apply the ksm settings from the config first",
+    )
+    parser.add_argument("--label", help="only report vms with this label")
+    parser.add_argument(
+        "pattern", nargs="?", help="only report vms with a name matching this pattern"
+    )
+
+    args = vars(parser.parse_args())
+
+    if args["config"]:
+        config = Config(args["config"])
+    else:
+        config = Config(default_config_file())
+
+    if args["configure"]:
+        configure_ksm(config)
+
+    vms = Inventory(config.inventory).find(pattern=args["pattern"], label=args["label"])
+    print(f"{'NAME':<24} {'MAXIMUM':>12} {'BALLOON':>12} {'RESIDENT':>12} RECLAIMED")
+    total = 0
+    for vm in vms:
+        stats = memory_stats(vm["name"])
+        if stats is None:
+            continue
+        # Memory given back by the balloon, and memory the guest reported as free
+        # (or never touched) so the host does not back it
+        reclaimed = max(stats["maximum"] - stats["rss"], 0) * 1024
+        total += reclaimed
+        print(
+            f"{vm['name']:<24} {human_size(stats['maximum'] * 1024):>12} "
+            f"{human_size(stats['actual'] * 1024):>12} "
+            f"{human_size(stats['rss'] * 1024):>12} {human_size(reclaimed)}"
+        )
+    print(f"Reclaimed from the vms: {human_size(total)}")
+
+    ksm = KSM(config.ksm_root)
+    if ksm.available():
+        stats = ksm.stats()
+        print(
+            f"KSM is {'running' if ksm.read('run') == 1 else 'not running'}, "
+            + ", ".join(f"{name} {value}" for name, value in stats.items())
+        )
+        print(f"Saved by KSM: {human_size(ksm.saved_bytes())}")
+    else:
+        print("KSM is not available")
@@ -14,100 +14,396 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+
+import json
 import os
 import subprocess
 import tempfile
 import time
 
+from bootstrap_vm import metrics, mirrors
 from bootstrap_vm.constants import ONE_DAY
+from bootstrap_vm.delta import DeltaUnavailable, delta_download
+
+# Every distribution has a list of mirrors and url templates for the image, the
+# checksum file and the (optional) detached gpg signature of the checksum file.
+# Variants can override any of the distribution keys. Templates are formatted
+# with the mirror, the variant and the keys of the variant.
+DISTRIBUTIONS = {
+    "ubuntu": {
+        "name": "Ubuntu",
+        "default_variant": "bionic",
+        "user": "ubuntu",
+        "mirrors": ["https://cloud-images.ubuntu.com"],
+        "image": "{mirror}/{variant}/current/{variant}-server-cloudimg-amd64.img",
+        "checksums": "{mirror}/{variant}/current/SHA256SUMS",
+        "signature": "{mirror}/{variant}/current/SHA256SUMS.gpg",
+        "checksum_type": "sha256",
+        "convert": False,
+        "libosinfo_id": "http://ubuntu.com/ubuntu/{version}",
+        "variants": {
+            "xenial": {
+                "version": "16.04",
+                "image": "{mirror}/xenial/current/xenial-server-cloudimg-amd64-disk1.img",
+            },
+            "bionic": {"version": "18.04", "convert": True},
+            "focal": {"version": "20.04"},
+            "jammy": {"version": "22.04"},
+        },
+    },
+    "debian": {
+        "name": "Debian",
+        "default_variant": "bookworm",
+        "user": "debian",
+        "mirrors": ["https://cloud.debian.org/images/cloud"],
+        "image": "{mirror}/{variant}/latest/debian-{version}-generic-amd64.qcow2",
+        "checksums": "{mirror}/{variant}/latest/SHA512SUMS",
+        "signature": None,
+        "checksum_type": "sha512",
+        "convert": False,
+        "libosinfo_id": "http://debian.org/debian/{version}",
+        "variants": {
+            "buster": {"version": "10"},
+            "bullseye": {"version": "11"},
+            "bookworm": {"version": "12"},
+        },
+    },
+}
+
+
+def registry(config=None):
+    """
+    The known distributions, the distributions and mirrors options of the config
+    add distributions and variants or replace the mirrors of a distribution
+    """
+    distributions = {
+        key: {**value, "variants": dict(value["variants"])}
+        for key, value in DISTRIBUTIONS.items()
+    }
+    if config is None:
+        return distributions
+    for key, value in (config.get("distributions") or {}).items():
+        existing = distributions.get(key, {"variants": {}})
+        distributions[key] = {
+            **existing,
+            **value,
+            "variants": {**existing["variants"], **value.get("variants", {})},
+        }
+    for key, value in (config.get("mirrors") or {}).items():
+        if key in distributions:
+            distributions[key]["mirrors"] = value
+    return distributions
+
+
+def all_variants(config=None):
+    """Returns (distribution, variant) for every known variant"""
+    return [
+        (key, variant)
+        for key, value in registry(config).items()
+        for variant in value["variants"]
+    ]
 
 
-class Ubuntu:
+def get_distribution(name, variant=None, config=None):
+    """Look up a distribution by its key or its name, like ubuntu or Ubuntu"""
+    distributions = registry(config)
+    for key, value in distributions.items():
+        if name.lower() in (key, value["name"].lower()):
+            return Distribution(key, variant, config)
+    raise RuntimeError(f"Unknown distribution {name}")
+
+
+class Distribution:
+    def __init__(self, key, variant=None, config=None):
+        self._definition = registry(config)[key]
+        if variant is None:
+            variant = self._definition["default_variant"]
+        if variant not in self._definition["variants"]:
+            raise RuntimeError(f"Unknown variant {variant} for {self.distribution}")
+        self.key = key
+        self._variant = variant
+        self._config = config
+        self._options = {
+            **self._definition,
+            "variant": variant,
+            **self._definition["variants"][variant],
+        }
+        self._mirrors = None
+
     @property
     def distribution(self):
-        return "Ubuntu"
+        return self._definition["name"]
 
     @property
     def variant(self):
         return self._variant
 
-    urls = {
-        "bionic": {
-            "image": "https://cloud-images.ubuntu.com/bionic/current/bionic-server-cloudimg-amd64.img",
-            "hashes": "https://cloud-images.ubuntu.com/bionic/current/SHA256SUMS",
-            "signature": "https://cloud-images.ubuntu.com/bionic/current/SHA256SUMS.gpg",
-            "libosinfo_id": "http://ubuntu.com/ubuntu/18.04",
-        },
-        "xenial": {
-            "image": "https://cloud-images.ubuntu.com/xenial/current/xenial-server-cloudimg-amd64-disk1.img",
-            "hashes": "https://cloud-images.ubuntu.com/xenial/current/SHA256SUMS",
-            "signature": "https://cloud-images.ubuntu.com/xenial/current/SHA256SUMS.gpg",
-            "libosinfo_id": "http://ubuntu.com/ubuntu/16.04",
-        },
-    }
+    @property
+    def user(self):
+        return self._options["user"]
 
-    def __init__(self, variant=None):
-        if variant is None:
-            variant = "bionic"
-        if variant not in self.urls:
-            raise RuntimeError(f"Unknown variant {variant} for Ubuntu")
-        self._variant = variant
+    @property
+    def libosinfo_id(self):
+        return self._format("libosinfo_id")
 
-    def download(self, image_location):
-        if os.path.isfile(image_location) and os.path.getctime(image_location) > (
-            time.time() - ONE_DAY
-        ):
-            return
-        raw_location, _ = os.path.splitext(image_location)
-        raw_location = raw_location + ".raw"
+    @property
+    def needs_conversion(self):
+        return self._options["convert"]
 
-        if self._variant == "bionic":
-            subprocess.run(
-                [
-                    "wget",
-                    "--inet4-only",
-                    "-O",
-                    raw_location,
-                    self.urls[self._variant]["image"],
-                ]
-            )
-            subprocess.run(
-                ["qemu-img", "convert", "-O", "qcow2", raw_location, image_location]
-            )
-        elif self._variant == "xenial":
-            subprocess.run(
-                [
-                    "wget",
-                    "--inet4-only",
-                    "-O",
-                    image_location,
-                    self.urls[self._variant]["image"],
-                ]
+    @property
+    def checksum_type(self):
+        return self._options["checksum_type"]
+
+    def _format(self, option, mirror=None):
+        if self._options[option] is None:
+            return None
+        if mirror is None:
+            mirror = self._definition["mirrors"][0]
+        return self._options[option].format(mirror=mirror, **self._options)
+
+    @property
+    def filename(self):
+        return self._format("image").split("/")[-1]
+
+    def mirrors(self):
+        """The mirrors of this distribution, fastest first"""
+        if self._mirrors is None:
+            candidates = {
+                self._format("image", mirror): mirror
+                for mirror in self._definition["mirrors"]
+            }
+            config = self._config
+            ranking = mirrors.rank(
+                list(candidates),
+                config.get("mirror_cache") if config else None,
+                config.get("mirror_ttl", ONE_DAY) if config else ONE_DAY,
             )
+            self._mirrors = [candidates[url] for url in ranking]
+        return self._mirrors
+
+    def urls(self, option):
+        return [self._format(option, mirror) for mirror in self.mirrors()]
+
+    def image_url(self):
+        return self.urls("image")[0]
+
+    def cache_location(self, images_path):
+        return os.path.join(images_path, f"{self.distribution}-{self.variant}.img")
+
+    def needs_download(self, image_location, max_age=ONE_DAY):
+        """
+        Check if the cached image should be downloaded again, a max_age of None means
+        that the cached image is used regardless of its age (it is kept up to date
+        by prefetch-vm)
+        """
+        if os.path.isfile(image_location):
+            if max_age is None or os.path.getctime(image_location) > (
+                time.time() - max_age
+            ):
+                metrics.image_cache.inc(result="hit")
+                return False
+            metrics.image_cache.inc(result="revalidation")
         else:
-            raise NotImplementedError(f"variant {self._variant} is not supported")
+            metrics.image_cache.inc(result="miss")
+        return True
 
-    def verify(self, image_location):
-        with tempfile.NamedTemporaryFile() as hashes, tempfile.NamedTemporaryFile() as signature, tempfile.NamedTemporaryFile() as image_hash:
-            subprocess.run(
-                [
-                    "wget",
-                    "--inet4-only",
-                    "-O",
-                    hashes.name,
-                    self.urls[self._variant]["hashes"],
-                ]
+    def seed_location(self, image_location):
+        """The previous download of the upstream image, used for delta refreshes"""
+        if self.needs_conversion:
+            raw_location, _ = os.path.splitext(image_location)
+            return raw_location + ".raw"
+        return image_location
+
+    def download(
+        self, image_location, block_map_url=None, rolling=False, peers=(), checksum=None
+    ):
+        """
+        Download the image to a staging file next to the cached image, the cached
+        image is only replaced by install after the download is verified. When the
+        checksum is known, the image is first requested from the peers (other hosts
+        running share-vm). With a block_map_url only the blocks that changed since
+        the previous download are fetched, if that is possible.
+        """
+        folder, image = os.path.split(image_location)
+        fd, download_location = tempfile.mkstemp(
+            dir=folder, prefix=image + ".", suffix=".part"
+        )
+        os.close(fd)
+        # The staging file is removed when the download fails, the caller only
+        # discards it after a successful download
+        try:
+            if peers and checksum:
+                urls = [f"{peer.rstrip('/')}/images/{checksum}" for peer in peers]
+                try:
+                    url = mirrors.download(urls, download_location)
+                    print(f"Downloaded the image from {url}")
+                    metrics.peer_downloads.inc(result="hit")
+                    return download_location
+                except RuntimeError:
+                    print("None of the peers has the image")
+                    metrics.peer_downloads.inc(result="miss")
+                    open(download_location, "wb").close()
+
+            seed_location = self.seed_location(image_location)
+            if block_map_url and os.path.isfile(seed_location):
+                try:
+                    fetched, reused = delta_download(
+                        self.image_url(),
+                        block_map_url,
+                        seed_location,
+                        download_location,
+                        rolling,
+                    )
+                    print(
+                        f"Delta refresh fetched {fetched / 2 ** 20:.1f} MiB and reused "
+                        f"{reused / 2 ** 20:.1f} MiB of the previous image"
+                    )
+                    metrics.downloaded_bytes.inc(fetched)
+                    metrics.delta_saved_bytes.inc(reused)
+                    return download_location
+                except (DeltaUnavailable, OSError) as e:
+                    print(
+                        f"Delta refresh is not possible, downloading the full image: {e}"
+                    )
+                    open(download_location, "wb").close()
+
+            mirrors.download(self.urls("image"), download_location)
+            metrics.downloaded_bytes.inc(os.path.getsize(download_location))
+            return download_location
+        except BaseException:
+            self.discard(download_location)
+            raise
+
+    def keep_downloads(self):
+        """
+        Converted images are rebuilt from the download, the download is only kept
+        when it is needed as the seed for delta refreshes or to share with peers
+        """
+        config = self._config
+        return bool(config and (config.get("delta") or config.get("keep_downloads")))
+
+    def image_format(self):
+        """The qcow2 options of converted images, tuned to be copied to new disks"""
+        config = self._config or {}
+        return {
+            "format": "qcow2",
+            "cluster_size": config.get("image_cluster_size", "64k"),
+            # Compressed clusters cannot be preallocated
+            "preallocation": (
+                "off"
+                if config.get("image_compress")
+                else config.get("image_preallocation", "metadata")
+            ),
+            "compressed": bool(config.get("image_compress")),
+        }
+
+    def convert(self, download_location, output):
+        image_format = self.image_format()
+        command = [
+            "qemu-img",
+            "convert",
+            "-O",
+            image_format["format"],
+            "-o",
+            f"cluster_size={image_format['cluster_size']},"
+            f"preallocation={image_format['preallocation']}",
+        ]
+        if image_format["compressed"]:
+            command.append("-c")
+        subprocess.run([*command, download_location, output], check=True)
+        return image_format
+
+    def install(self, download_location, image_location, checksum):
+        """Atomically replace the cached image by a verified download"""
+        image_format = None
+        if self.needs_conversion:
+            staging_location = download_location + ".qcow2"
+            image_format = self.convert(download_location, staging_location)
+            os.replace(staging_location, image_location)
+            if self.keep_downloads():
+                os.replace(download_location, self.seed_location(image_location))
+            else:
+                os.remove(download_location)
+                # Remove the download of a previous run that did keep it
+                if os.path.isfile(self.seed_location(image_location)):
+                    os.remove(self.seed_location(image_location))
+        else:
+            os.replace(download_location, image_location)
+        self.write_metadata(image_location, checksum, image_format)
+
+    def discard(self, download_location):
+        for location in [download_location, download_location + ".qcow2"]:
+            if os.path.isfile(location):
+                os.remove(location)
+
+    def write_metadata(self, image_location, checksum, image_format=None):
+        """
+        The checksum is the verified checksum of the download, so the cached image
+        can be checked against the checksum file without keeping the download
+        """
+        with open(image_location + ".json.tmp", "w") as f:
+            json.dump(
+                {
+                    "url": self._format("image"),
+                    "checksum_type": self.checksum_type,
+                    "checksum": checksum,
+                    "verified_at": time.time(),
+                    "format": image_format,
+                },
+                f,
             )
-            subprocess.run(
-                [
-                    "wget",
-                    "--inet4-only",
-                    "-O",
-                    signature.name,
-                    self.urls[self._variant]["signature"],
-                ]
+        os.replace(image_location + ".json.tmp", image_location + ".json")
+
+    @staticmethod
+    def read_metadata(image_location):
+        try:
+            with open(image_location + ".json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def refresh(self, image_location, block_map_url=None, rolling=False, peers=()):
+        """
+        Make sure the cached image is the latest verified image. The image is only
+        downloaded if the published checksum differs from the checksum of the cached
+        image. Returns True if a new image was installed.
+        """
+        checksums = self.fetch_checksums()
+        checksum = self.expected_checksum(checksums)
+        if (
+            os.path.isfile(image_location)
+            and self.read_metadata(image_location).get("checksum") == checksum
+        ):
+            # Touch the image so bootstrap-vm considers the cached image fresh again
+            os.utime(image_location)
+            self.write_metadata(
+                image_location,
+                checksum,
+                self.read_metadata(image_location).get("format"),
             )
+            return False
+
+        download_location = self.download(
+            image_location, block_map_url, rolling, peers, checksum
+        )
+        try:
+            self.verify(download_location, checksums)
+            self.install(download_location, image_location, checksum)
+        finally:
+            self.discard(download_location)
+        return True
 
+    def fetch_checksums(self):
+        """
+        Download the checksum file for this variant and check its signature, if the
+        distribution publishes one. Returns the contents of the verified file.
+        """
+        with tempfile.NamedTemporaryFile() as checksums, tempfile.NamedTemporaryFile() as signature:
+            mirrors.download(self.urls("checksums"), checksums.name)
+            if self._options["signature"] is None:
+                return checksums.read()
+
+            mirrors.download(self.urls("signature"), signature.name)
             subprocess.run(
                 [
                     "gpg",
@@ -115,32 +411,39 @@ class Ubuntu:
                     "/root/.gnupg",
                     "--verify",
                     signature.name,
-                    hashes.name,
+                    checksums.name,
                 ],
                 check=True,
             )
-            filename = self.urls[self._variant]["image"].split("/")[-1]
-            folder, image = image_location.rsplit("/", 1)
-            image, _ = os.path.splitext(image)
-
-            for line in hashes:
-                if line.strip().endswith(bytes(filename, encoding="utf-8")):
-                    if self._variant == "bionic":
-                        image_hash.file.write(
-                            line.split()[0]
-                            + b" "
-                            + bytes(image, encoding="utf-8")
-                            + b".raw\n"
-                        )
-                    else:
-                        image_hash.file.write(
-                            line.split()[0]
-                            + b" "
-                            + bytes(image, encoding="utf-8")
-                            + b".img\n"
-                        )
-                    break
-            image_hash.file.close()
+            return checksums.read()
+
+    def expected_checksum(self, checksums):
+        filename = bytes(self.filename, encoding="utf-8")
+        for line in checksums.splitlines():
+            if line.strip().endswith(filename):
+                return str(line.split()[0], encoding="utf-8")
+        raise RuntimeError(f"No checksum for {self.filename} found")
+
+    def verify(self, location, checksums=None):
+        """Check the file at location against the checksum file, returns the checksum"""
+        if checksums is None:
+            checksums = self.fetch_checksums()
+        checksum = self.expected_checksum(checksums)
+
+        folder, filename = os.path.split(location)
+        with tempfile.NamedTemporaryFile() as image_checksum:
+            image_checksum.file.write(
+                bytes(f"{checksum}  {filename}\n", encoding="utf-8")
+            )
+            image_checksum.file.close()
             subprocess.run(
-                ["sha256sum", "--check", image_hash.name], cwd=folder, check=True
+                [f"{self.checksum_type}sum", "--check", image_checksum.name],
+                cwd=folder,
+                check=True,
             )
+        return checksum
+
+
+class Ubuntu(Distribution):
+    def __init__(self, variant=None, config=None):
+        super().__init__("ubuntu", variant, config)
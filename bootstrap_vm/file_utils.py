@@ -104,3 +104,11 @@ def absent(dest, regexp, line=""):
 
     if changed:
         write_changes(b_lines, dest)
+
+
+def human_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
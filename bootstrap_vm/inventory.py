@@ -0,0 +1,247 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+from bootstrap_vm.config import Config, default_config_file
+
+# Every entry upgrades the database by one version, the current version is stored
+# in the user_version pragma of the database
+MIGRATIONS = [
+    [
+        """
+        CREATE TABLE vms (
+            name TEXT PRIMARY KEY,
+            macaddress TEXT,
+            ip TEXT,
+            hostname TEXT,
+            distribution TEXT,
+            variant TEXT,
+            base_image TEXT,
+            disk_location TEXT,
+            iso_location TEXT,
+            profile TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX vms_ip ON vms (ip)",
+        "CREATE INDEX vms_base_image ON vms (base_image)",
+    ],
+    [
+        "ALTER TABLE vms ADD COLUMN seed TEXT",
+        "CREATE INDEX vms_macaddress ON vms (macaddress)",
+    ],
+    [
+        """
+        CREATE TABLE labels (
+            name TEXT NOT NULL,
+            label TEXT NOT NULL,
+            PRIMARY KEY (name, label)
+        )
+        """,
+        "CREATE INDEX labels_label ON labels (label)",
+    ],
+]
+
+COLUMNS = [
+    "name",
+    "macaddress",
+    "ip",
+    "hostname",
+    "distribution",
+    "variant",
+    "base_image",
+    "disk_location",
+    "iso_location",
+    "profile",
+    "seed",
+]
+
+
+class Inventory:
+    """
+    Local record of the virtual machines managed by bootstrap-vm, so they can be
+    looked up without asking libvirt or scanning the images directories.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._migrated = False
+
+    @contextmanager
+    def _transaction(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o0700, exist_ok=True)
+        # A connection is opened for every transaction so the inventory can be used
+        # from the stages of the task graph, which run in different threads
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            conn.row_factory = sqlite3.Row
+            with conn:
+                if not self._migrated:
+                    self._migrate(conn)
+                yield conn
+
+    def _migrate(self, conn):
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        if version < len(MIGRATIONS):
+            # Other processes might be migrating as well, so take the write lock and
+            # read the version again. executescript would commit on its own, so
+            # every statement is executed separately within this transaction.
+            conn.execute("BEGIN IMMEDIATE")
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in migration:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        self._migrated = True
+
+    def add(self, vm, hostname=None, profile=None, labels=()):
+        now = time.time()
+        row = {
+            "name": vm.name,
+            "macaddress": vm.macaddress,
+            "ip": vm.args.get("ip"),
+            "hostname": hostname,
+            "distribution": vm.distribution.distribution,
+            "variant": vm.distribution.variant,
+            "base_image": vm.image_location,
+            "disk_location": vm.disk_location,
+            "iso_location": vm.iso_location,
+            "profile": profile,
+            # Everything that is needed to render the cloud-init seed later on
+            "seed": json.dumps(
+                {
+                    "public_keys": sorted(vm.args.get("public_keys") or []),
+                    "host_keys": vm.args.get("host_keys"),
+                    "netplan": vm.args.get("netplan"),
+                }
+            ),
+        }
+        with self._transaction() as conn:
+            existing = conn.execute(
+                "SELECT created_at FROM vms WHERE name = ?", (vm.name,)
+            ).fetchone()
+            created_at = existing["created_at"] if existing else now
+            conn.execute(
+                f"INSERT OR REPLACE INTO vms ({', '.join(COLUMNS)}, created_at, updated_at)"
+                f" VALUES ({', '.join('?' for _ in COLUMNS)}, ?, ?)",
+                [row[column] for column in COLUMNS] + [created_at, now],
+            )
+            conn.execute("DELETE FROM labels WHERE name = ?", (vm.name,))
+            conn.executemany(
+                "INSERT INTO labels (name, label) VALUES (?, ?)",
+                [(vm.name, label) for label in sorted(set(labels))],
+            )
+
+    def update(self, name, **fields):
+        for field in fields:
+            if field not in COLUMNS:
+                raise ValueError(f"Unknown inventory field {field}")
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self._transaction() as conn:
+            conn.execute(
+                f"UPDATE vms SET {assignments}, updated_at = ? WHERE name = ?",
+                [*fields.values(), time.time(), name],
+            )
+
+    def remove(self, name):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM vms WHERE name = ?", (name,))
+            conn.execute("DELETE FROM labels WHERE name = ?", (name,))
+
+    def labels(self, name):
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT label FROM labels WHERE name = ? ORDER BY label", (name,)
+            ).fetchall()
+        return [row["label"] for row in rows]
+
+    def get(self, name):
+        with self._transaction() as conn:
+            return conn.execute("SELECT * FROM vms WHERE name = ?", (name,)).fetchone()
+
+    def lookup(self, key):
+        """Find a vm by its name or mac address"""
+        with self._transaction() as conn:
+            return conn.execute(
+                "SELECT * FROM vms WHERE name = ? OR macaddress = ?", (key, key.lower())
+            ).fetchone()
+
+    def find(self, ip=None, base_image=None, pattern=None, label=None):
+        """Find vms by ip, base image, a glob pattern of the name or a label"""
+        conditions = []
+        values = []
+        if pattern is not None:
+            conditions.append("name GLOB ?")
+            values.append(pattern)
+        if label is not None:
+            conditions.append("name IN (SELECT name FROM labels WHERE label = ?)")
+            values.append(label)
+        if ip is not None:
+            conditions.append("ip = ?")
+            values.append(ip)
+        if base_image is not None:
+            conditions.append("base_image = ?")
+            values.append(base_image)
+        query = "SELECT * FROM vms"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self._transaction() as conn:
+            return conn.execute(query + " ORDER BY name", values).fetchall()
+
+
+def list_vm():
+    parser = argparse.ArgumentParser(
+        description="List the vms that were created using the bootstrap-vm script"
+    )
+    parser.add_argument("-c", "--config", help="config file to use")
+    parser.add_argument("--ip", help="only list the vm with this ip address")
+    parser.add_argument(
+        "--base-image", help="only list vms that were created from this image"
+    )
+    parser.add_argument("--label", help="only list vms with this label")
+    parser.add_argument(
+        "pattern", nargs="?", help="only list vms with a name matching this pattern"
+    )
+
+    args = vars(parser.parse_args())
+
+    if args["config"]:
+        config = Config(args["config"])
+    else:
+        config = Config(default_config_file())
+
+    vms = Inventory(config.inventory).find(
+        ip=args["ip"],
+        base_image=args["base_image"],
+        pattern=args["pattern"],
+        label=args["label"],
+    )
+    print(f"{'NAME':<24} {'IP':<16} {'MAC':<18} {'IMAGE':<16} {'PROFILE':<12} CREATED")
+    for vm in vms:
+        image = f"{vm['distribution']}-{vm['variant']}"
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(vm["created_at"]))
+        print(
+            f"{vm['name']:<24} {vm['ip'] or '-':<16} {vm['macaddress'] or '-':<18} "
+            f"{image:<16} {vm['profile'] or '-':<12} {created}"
+        )
@@ -0,0 +1,259 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import fcntl
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from bootstrap_vm.server import serve_in_background
+
+DURATION_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+SIZE_BUCKETS = [2**power for power in range(20, 36, 2)]
+
+REGISTRY = []
+
+
+class Metric:
+    kind = None
+    suffixes = ("",)
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} needs the labels {', '.join(self.labels)}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _sample(self, suffix, key, extra=()):
+        pairs = [*zip(self.labels, key), *extra]
+        if not pairs:
+            return self.name + suffix
+        labels = ",".join(f'{label}="{value}"' for label, value in pairs)
+        return f"{self.name}{suffix}{{{labels}}}"
+
+    def samples(self):
+        with self._lock:
+            return [
+                (self._sample("", key), value) for key, value in self._values.items()
+            ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    suffixes = ("_bucket", "_sum", "_count")
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            buckets, count, total = self._values.get(
+                key, ([0] * len(self.buckets), 0, 0)
+            )
+            buckets = [
+                observations + (1 if value <= bucket else 0)
+                for observations, bucket in zip(buckets, self.buckets)
+            ]
+            self._values[key] = (buckets, count + 1, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (buckets, count, total) in self._values.items():
+                for bucket, observations in zip(self.buckets, buckets):
+                    le = [("le", str(bucket))]
+                    samples.append((self._sample("_bucket", key, le), observations))
+                le = [("le", "+Inf")]
+                samples.append((self._sample("_bucket", key, le), count))
+                samples.append((self._sample("_sum", key), total))
+                samples.append((self._sample("_count", key), count))
+        return samples
+
+
+def render(values=None):
+    """
+    Render all metrics in the Prometheus text format, values can override the
+    samples of this process (used to write the merged textfile)
+    """
+    lines = []
+    for metric in REGISTRY:
+        samples = metric.samples()
+        if values is not None:
+            names = {metric.name + suffix for suffix in metric.suffixes}
+            samples = [
+                (sample, value)
+                for sample, value in values.items()
+                if sample.split("{", 1)[0] in names
+            ]
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample, value in samples:
+            lines.append(f"{sample} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+def read_textfile(path):
+    values = {}
+    if not os.path.isfile(path):
+        return values
+    with open(path) as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            sample, value = line.rsplit(None, 1)
+            values[sample] = float(value)
+    return values
+
+
+_flushed = {}
+
+
+def write_textfile(path):
+    """
+    Add everything that changed since the last write to the textfile for the
+    node exporter textfile collector. Every bootstrap-vm command is a separate
+    process, so the values in the file are the totals over all of them.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        values = read_textfile(path)
+        for metric in REGISTRY:
+            for sample, value in metric.samples():
+                values[sample] = values.get(sample, 0) + value - _flushed.get(sample, 0)
+                _flushed[sample] = value
+        with open(path + ".tmp", "w") as f:
+            f.write(render(values))
+        # The collector might read the file at any moment, so replace it atomically
+        os.replace(path + ".tmp", path)
+
+
+def flush(config):
+    if config.get("metrics_textfile"):
+        write_textfile(config.metrics_textfile)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = bytes(render(), encoding="utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(config):
+    """Serve /metrics over HTTP for long-running commands, if metrics_port is set"""
+    if config.get("metrics_port"):
+        return serve_in_background(
+            MetricsHandler, (config.get("metrics_address", ""), config.metrics_port)
+        )
+    return None
+
+
+stage_duration = Histogram(
+    "bootstrap_vm_stage_duration_seconds",
+    "Time spent in every stage of creating or removing a virtual machine",
+    labels=["operation", "stage"],
+)
+stage_disk_usage = Histogram(
+    "bootstrap_vm_stage_disk_usage_bytes",
+    "Peak growth of the used space on the images filesystem while every stage of "
+    "creating a virtual machine ran, including the writes of concurrent stages",
+    labels=["operation", "stage"],
+    buckets=SIZE_BUCKETS,
+)
+operation_duration = Histogram(
+    "bootstrap_vm_operation_duration_seconds",
+    "Total time spent creating or removing a virtual machine",
+    labels=["operation"],
+)
+image_cache = Counter(
+    "bootstrap_vm_image_cache_total",
+    "Lookups of the cached base image, by result (hit, miss or revalidation)",
+    labels=["result"],
+)
+downloaded_bytes = Counter(
+    "bootstrap_vm_downloaded_bytes_total", "Bytes of images downloaded"
+)
+delta_saved_bytes = Counter(
+    "bootstrap_vm_delta_saved_bytes_total",
+    "Bytes of images reused from the previous image by delta refreshes",
+)
+peer_downloads = Counter(
+    "bootstrap_vm_peer_downloads_total",
+    "Images requested from peers, by result (hit or miss)",
+    labels=["result"],
+)
+shared_bytes = Counter(
+    "bootstrap_vm_shared_bytes_total", "Bytes of images served to peers by share-vm"
+)
+copied_bytes = Counter(
+    "bootstrap_vm_copied_bytes_total", "Bytes of base images copied to new disks"
+)
+prefetches = Counter(
+    "bootstrap_vm_prefetch_total",
+    "Refreshes of cached images by prefetch-vm, by result",
+    labels=["result"],
+)
+retries = Counter(
+    "bootstrap_vm_retries_total",
+    "Retries while waiting for the ip address or ssh of a new virtual machine",
+    labels=["kind"],
+)
+seed_requests = Counter(
+    "bootstrap_vm_seed_requests_total",
+    "Requests for cloud-init seed files served by seed-vm",
+    labels=["file"],
+)
+in_flight = Gauge(
+    "bootstrap_vm_in_flight", "Virtual machines that are currently being created"
+)
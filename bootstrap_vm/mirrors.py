@@ -0,0 +1,125 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import fcntl
+import json
+import os
+import subprocess
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from bootstrap_vm.constants import ONE_DAY
+
+# Mirrors are probed by downloading the first PROBE_SIZE bytes of the image and
+# ranked by the estimated time it takes to download ESTIMATE_SIZE bytes
+PROBE_SIZE = 1024 * 1024
+ESTIMATE_SIZE = 300 * 1024 * 1024
+
+
+def probe(url, timeout=10):
+    """Returns the latency and throughput (bytes per second) of url, or None"""
+    request = urllib.request.Request(
+        url, headers={"Range": f"bytes=0-{PROBE_SIZE - 1}"}
+    )
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            received = len(response.read(1))
+            latency = time.monotonic() - start
+            received += len(response.read(PROBE_SIZE - 1))
+    except OSError:
+        return None
+    transfer = max(time.monotonic() - start - latency, 0.001)
+    return latency, received / transfer
+
+
+def estimate(measurement):
+    if measurement is None:
+        return float("inf")
+    latency, throughput = measurement
+    return latency + ESTIMATE_SIZE / max(throughput, 1)
+
+
+def rank(urls, cache_location=None, ttl=ONE_DAY):
+    """
+    Probe all urls at the same time and return them ordered from fastest to
+    slowest. The ranking is cached in cache_location for ttl seconds.
+    """
+    if len(urls) < 2:
+        return list(urls)
+
+    key = " ".join(sorted(urls))
+    cache = {}
+    if cache_location and os.path.isfile(cache_location):
+        with open(cache_location) as f:
+            try:
+                cache = json.load(f)
+            except ValueError:
+                cache = {}
+    cached = cache.get(key)
+    if cached and cached["measured_at"] > time.time() - ttl:
+        return cached["ranking"]
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        measurements = dict(zip(urls, executor.map(probe, urls)))
+    ranking = sorted(urls, key=lambda url: estimate(measurements[url]))
+    for url in ranking:
+        if measurements[url] is None:
+            print(f"Mirror {url} is not reachable")
+        else:
+            latency, throughput = measurements[url]
+            print(
+                f"Mirror {url}: {latency * 1000:.0f} ms latency, "
+                f"{throughput / 2 ** 20:.1f} MiB/s"
+            )
+
+    if cache_location:
+        update_cache(
+            cache_location, key, {"ranking": ranking, "measured_at": time.time()}
+        )
+    return ranking
+
+
+def update_cache(cache_location, key, value):
+    os.makedirs(os.path.dirname(cache_location), exist_ok=True)
+    with open(cache_location + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = {}
+        if os.path.isfile(cache_location):
+            with open(cache_location) as f:
+                try:
+                    cache = json.load(f)
+                except ValueError:
+                    pass
+        cache[key] = value
+        with open(cache_location + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cache_location + ".tmp", cache_location)
+
+
+def download(urls, output):
+    """
+    Download the first url to output, when a download fails it is continued from
+    the next url. Returns the url the download finished from.
+    """
+    for url in urls:
+        out = subprocess.run(["wget", "--inet4-only", "--continue", "-O", output, url])
+        if out.returncode == 0:
+            return url
+        print(f"Downloading {url} failed, continuing with the next mirror")
+    raise RuntimeError(f"Downloading {os.path.basename(output)} failed on all mirrors")
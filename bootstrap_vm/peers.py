@@ -0,0 +1,149 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import re
+import sys
+from functools import partial
+from http.server import BaseHTTPRequestHandler
+
+from bootstrap_vm import metrics
+from bootstrap_vm.config import Config, default_config_file
+from bootstrap_vm.distributions import Distribution, all_variants
+from bootstrap_vm.prefetch import start_prefetcher
+from bootstrap_vm.server import ThreadingHTTPServer
+
+
+def shared_images(config):
+    """
+    The verified images this host can share, by checksum. The shared file is the
+    image as it was downloaded, so peers can check it against the checksum file.
+    """
+    images = {}
+    for key, variant in all_variants(config):
+        distribution = Distribution(key, variant, config)
+        image_location = distribution.cache_location(config.images_path)
+        metadata = distribution.read_metadata(image_location)
+        location = distribution.seed_location(image_location)
+        if metadata.get("checksum") and os.path.isfile(location):
+            images[metadata["checksum"]] = {
+                "name": f"{distribution.distribution}-{variant}",
+                "checksum_type": metadata["checksum_type"],
+                "checksum": metadata["checksum"],
+                "size": os.path.getsize(location),
+                "location": location,
+            }
+    return images
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """
+    Serves /images with a list of the shared images and /images/<checksum> with
+    the image itself, range requests are supported so downloads can be continued
+    """
+
+    def __init__(self, *args, config, **kwargs):
+        self.config = config
+        super().__init__(*args, **kwargs)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        images = shared_images(self.config)
+        if self.path.rstrip("/") == "/images":
+            listing = [
+                {key: value for key, value in image.items() if key != "location"}
+                for image in images.values()
+            ]
+            self.send_body(
+                bytes(json.dumps(listing), encoding="utf-8"), "application/json"
+            )
+            return
+
+        match = re.fullmatch(r"/images/([0-9a-f]+)", self.path)
+        if not match or match.group(1) not in images:
+            self.send_error(404)
+            return
+        location = images[match.group(1)]["location"]
+        size = os.path.getsize(location)
+
+        start, end = 0, size - 1
+        requested = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if requested:
+            start = int(requested.group(1))
+            end = min(int(requested.group(2) or end), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        with open(location, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+                metrics.shared_bytes.inc(len(chunk))
+
+
+def share_vm():
+    parser = argparse.ArgumentParser(
+        description="Share the verified cached images with other hosts"
+    )
+    parser.add_argument("-c", "--config", help="config file to use")
+    parser.add_argument("--address", help="address to listen on")
+    parser.add_argument("--port", type=int, help="port to listen on")
+
+    args = vars(parser.parse_args())
+
+    if args["config"]:
+        config = Config(args["config"])
+    else:
+        config = Config(default_config_file())
+
+    address = (
+        args["address"] or config.share_address,
+        args["port"] or config.share_port,
+    )
+    try:
+        server = ThreadingHTTPServer(address, partial(ImageHandler, config=config))
+    except OSError as e:
+        print(f"Could not listen on {address[0]}:{address[1]}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    metrics.serve(config)
+    start_prefetcher(config)
+    print(f"Sharing images on {address[0]}:{address[1]}")
+    server.serve_forever()
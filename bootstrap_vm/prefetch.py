@@ -0,0 +1,132 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import sys
+import threading
+import time
+
+from bootstrap_vm import metrics
+from bootstrap_vm.config import Config, default_config_file
+from bootstrap_vm.delta import block_map_url
+from bootstrap_vm.distributions import all_variants, get_distribution
+
+
+def prefetch(config, variants=None):
+    """
+    Refresh the cached image of every variant, returns False if one of them could
+    not be refreshed. Interactive bootstraps keep using the previous verified
+    image until a new one is installed.
+    """
+    variants = (
+        variants
+        or config.prefetch_variants
+        or [f"{key}/{variant}" for key, variant in all_variants(config)]
+    )
+    success = True
+    for variant in variants:
+        # A failing variant (a full disk, an unknown variant in prefetch_variants)
+        # should not stop the other variants or the background prefetcher
+        try:
+            distribution = parse_variant(variant, config)
+            image_location = distribution.cache_location(config.images_path)
+            print(f"Refreshing {distribution.distribution} {distribution.variant}")
+            url = block_map_url(config, distribution.image_url())
+            if distribution.refresh(
+                image_location, url, config.delta_rolling, config.peers
+            ):
+                print(f"Installed a new image in {image_location}")
+                metrics.prefetches.inc(result="updated")
+            else:
+                print(f"{image_location} is up to date")
+                metrics.prefetches.inc(result="unchanged")
+        except Exception as e:
+            print(f"Refreshing {variant} failed: {e}", file=sys.stderr)
+            metrics.prefetches.inc(result="failed")
+            success = False
+    metrics.flush(config)
+    return success
+
+
+def parse_variant(variant, config):
+    """Variants are given as distribution/variant, or only the variant"""
+    if "/" in variant:
+        name, variant = variant.split("/", 1)
+    else:
+        name = config.distribution
+    return get_distribution(name, variant, config)
+
+
+def prefetch_forever(config, variants, interval):
+    while True:
+        try:
+            prefetch(config, variants)
+        except Exception as e:
+            # Writing the metrics can fail as well, keep refreshing anyway
+            print(f"Prefetching failed: {e}", file=sys.stderr)
+        time.sleep(interval)
+
+
+def start_prefetcher(config):
+    """Refresh the images in the background for long-running commands"""
+    if not config.prefetch_interval:
+        return None
+    thread = threading.Thread(
+        target=prefetch_forever,
+        args=(config, None, config.prefetch_interval),
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+
+def prefetch_vm():
+    parser = argparse.ArgumentParser(
+        description="Download and verify new base images before they are needed"
+    )
+    parser.add_argument("-c", "--config", help="config file to use")
+    parser.add_argument(
+        "--variant",
+        action="append",
+        dest="variants",
+        help="only refresh this variant, like ubuntu/bionic (can be given multiple times)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        help="keep running and refresh the images every INTERVAL seconds",
+    )
+
+    args = vars(parser.parse_args())
+
+    if args["config"]:
+        config = Config(args["config"])
+    else:
+        config = Config(default_config_file())
+
+    for variant in args["variants"] or []:
+        try:
+            parse_variant(variant, config)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
+    if args["interval"]:
+        metrics.serve(config)
+        prefetch_forever(config, args["variants"], args["interval"])
+    elif not prefetch(config, args["variants"]):
+        sys.exit(1)
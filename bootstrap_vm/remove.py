@@ -17,28 +17,46 @@
 import argparse
 import os
 import subprocess
+import time
 
+from bootstrap_vm import metrics
 from bootstrap_vm.config import Config, default_config_file
 from bootstrap_vm.file_utils import absent
+from bootstrap_vm.inventory import Inventory
 
 
 def remove(name, config, confirm=True):
+    start = time.monotonic()
     commands = [
-        ["virsh", "destroy", name],
-        ["virsh", "undefine", name],
-        ["rm", os.path.join(config.images_path, f"{name}.img")],
-        ["rm", os.path.join(config.iso_path, f"{name}.iso")],
-        ["ssh-keygen", "-f", "/root/.ssh/known_hosts", "-R", f"{name}.fredvm"],
+        ("destroy", ["virsh", "destroy", name]),
+        # Snapshots are stored in the disk, but libvirt keeps metadata about them
+        ("undefine", ["virsh", "undefine", "--snapshots-metadata", name]),
+        ("remove_disk", ["rm", os.path.join(config.images_path, f"{name}.img")]),
+        ("remove_iso", ["rm", "-f", os.path.join(config.iso_path, f"{name}.iso")]),
+        (
+            "known_hosts",
+            ["ssh-keygen", "-f", "/root/.ssh/known_hosts", "-R", f"{name}.fredvm"],
+        ),
     ]
-    for command in commands:
+    for stage, command in commands:
         print(" ".join(command))
         if not confirm or input("Do you want to run this? [Y/n] ").lower() != "n":
+            stage_start = time.monotonic()
             subprocess.run(command)
+            metrics.stage_duration.observe(
+                time.monotonic() - stage_start, operation="remove", stage=stage
+            )
 
     print("Removing ip from /etc/hosts")
     if not confirm or input("Do you want to run this? [Y/n] ").lower() != "n":
         absent("/etc/hosts", name + ".fredvm$")
 
+    print(f"Removing {name} from the inventory")
+    if not confirm or input("Do you want to run this? [Y/n] ").lower() != "n":
+        Inventory(config.inventory).remove(name)
+
+    metrics.operation_duration.observe(time.monotonic() - start, operation="remove")
+
 
 def remove_vm():
     parser = argparse.ArgumentParser(
@@ -63,3 +81,4 @@ def remove_vm():
 
     for name in args["name"]:
         remove(name, config, args["step"])
+    metrics.flush(config)
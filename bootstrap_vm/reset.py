@@ -0,0 +1,111 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import subprocess
+import sys
+import time
+
+from bootstrap_vm import metrics
+from bootstrap_vm.config import Config, default_config_file
+
+SNAPSHOT = "clean"
+
+
+def create_snapshot(name):
+    """
+    Take a snapshot of the running vm, including its memory, so a reset continues
+    from this point without booting (and keeps the address it got from DHCP)
+    """
+    subprocess.run(
+        [
+            "virsh",
+            "snapshot-create-as",
+            name,
+            SNAPSHOT,
+            "--description",
+            "The state right after bootstrap-vm, used by reset-vm",
+            "--atomic",
+        ],
+        check=True,
+    )
+
+
+def has_snapshot(name):
+    return (
+        subprocess.run(
+            ["virsh", "snapshot-info", name, SNAPSHOT],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        == 0
+    )
+
+
+def reset(name):
+    if not has_snapshot(name):
+        raise RuntimeError(
+            f"{name} has no {SNAPSHOT} snapshot, create it with bootstrap-vm --snapshot"
+        )
+    start = time.monotonic()
+    commands = [
+        # Destroying fails if the vm is not running, which is fine
+        ("destroy", ["virsh", "destroy", name], False),
+        (
+            "revert",
+            ["virsh", "snapshot-revert", name, SNAPSHOT, "--running", "--force"],
+            True,
+        ),
+    ]
+    for stage, command, check in commands:
+        print(" ".join(command))
+        stage_start = time.monotonic()
+        subprocess.run(command, check=check, stderr=None if check else subprocess.PIPE)
+        metrics.stage_duration.observe(
+            time.monotonic() - stage_start, operation="reset", stage=stage
+        )
+    duration = time.monotonic() - start
+    metrics.operation_duration.observe(duration, operation="reset")
+    print(f"Reset {name} in {duration:.1f}s")
+
+
+def reset_vm():
+    parser = argparse.ArgumentParser(
+        description="Reset vms to the snapshot taken when they were created"
+    )
+    parser.add_argument("-c", "--config", help="config file to use")
+    parser.add_argument(
+        "name", nargs="+", help="the name of the virtual machine you want to reset"
+    )
+
+    args = vars(parser.parse_args())
+
+    if args["config"]:
+        config = Config(args["config"])
+    else:
+        config = Config(default_config_file())
+
+    failed = []
+    for name in args["name"]:
+        try:
+            reset(name)
+        except (RuntimeError, subprocess.CalledProcessError) as e:
+            print(f"Could not reset {name}: {e}", file=sys.stderr)
+            failed.append(name)
+    metrics.flush(config)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,253 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import asyncio
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+from bootstrap_vm.config import Config, default_config_file
+from bootstrap_vm.distributions import get_distribution
+from bootstrap_vm.inventory import Inventory
+
+
+class Host:
+    def __init__(self, record, user, control_dir, config):
+        self.name = record["name"]
+        self.address = record["ip"] or record["hostname"] or record["name"]
+        self.control_path = os.path.join(control_dir, self.name)
+        self.status = None
+        self.failed_step = None
+        self.error = None
+        self.master_started = False
+        if user is None:
+            try:
+                user = get_distribution(record["distribution"], config=config).user
+            except RuntimeError as e:
+                # Only this host fails, the distribution might have been removed
+                # from the config after the vm was created
+                self.error = str(e)
+        self.destination = f"{user}@{self.address}"
+
+    def ssh(self, *args):
+        return [
+            "ssh",
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            f"ControlPath={self.control_path}",
+            *args,
+        ]
+
+    def stop_master(self):
+        """Stop the master connection, used when run-vm is interrupted"""
+        if self.master_started and os.path.exists(self.control_path):
+            subprocess.run(
+                [*self.ssh("-O", "exit"), self.destination],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+
+async def stream(reader, prefix, output):
+    # Lines are split here instead of with readline, which fails on lines that do
+    # not fit in the buffer of the reader
+    pending = b""
+    while True:
+        chunk = await reader.read(64 * 1024)
+        if not chunk:
+            break
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            output.write(prefix + str(line, encoding="utf-8", errors="replace") + "\n")
+        output.flush()
+    if pending:
+        output.write(prefix + str(pending, encoding="utf-8", errors="replace") + "\n")
+        output.flush()
+
+
+async def run_host(host, steps, width):
+    """Run every step on the host over one multiplexed ssh connection"""
+    prefix = f"{host.name:<{width}} | "
+    if host.error:
+        return
+    # The master connection is started separately and its errors go to a file: the
+    # master keeps its output open after it goes to the background, so reading its
+    # output from a pipe would wait until the master exits. The master goes to the
+    # background in its own session, so Ctrl-C does not reach it: it is stopped
+    # explicitly, and exits by itself after a minute without connections.
+    host.master_started = True
+    with tempfile.TemporaryFile() as errors:
+        master = await asyncio.create_subprocess_exec(
+            *host.ssh("-o", "ControlMaster=yes", "-o", "ControlPersist=60", "-N", "-f"),
+            host.destination,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=errors,
+        )
+        if await master.wait() != 0:
+            errors.seek(0)
+            for line in errors:
+                sys.stderr.write(prefix + str(line, encoding="utf-8", errors="replace"))
+            host.status = master.returncode
+            host.failed_step = "connect"
+            return
+
+    try:
+        for number, step in enumerate(steps, start=1):
+            process = await asyncio.create_subprocess_exec(
+                *host.ssh("-o", "ControlMaster=no"),
+                host.destination,
+                "--",
+                step,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            await asyncio.gather(
+                stream(process.stdout, prefix, sys.stdout),
+                stream(process.stderr, prefix, sys.stderr),
+            )
+            host.status = await process.wait()
+            if host.status != 0:
+                host.failed_step = number
+                return
+    finally:
+        exit_master = await asyncio.create_subprocess_exec(
+            *host.ssh("-O", "exit"),
+            host.destination,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        await exit_master.wait()
+
+
+async def run_all(hosts, steps, parallel):
+    queue = asyncio.Queue()
+    for host in hosts:
+        queue.put_nowait(host)
+    width = max(len(host.name) for host in hosts)
+
+    async def worker():
+        while not queue.empty():
+            host = queue.get_nowait()
+            await run_host(host, steps, width)
+
+    await asyncio.gather(*(worker() for _ in range(min(parallel, len(hosts)))))
+
+
+def read_steps(filename):
+    """A step file is a yaml list of commands, which are run in order"""
+    with open(filename) as f:
+        steps = yaml.safe_load(f)
+    if not isinstance(steps, list) or not all(isinstance(s, str) for s in steps):
+        raise RuntimeError(f"{filename} should contain a list of commands")
+    return steps
+
+
+def run_vm():
+    parser = argparse.ArgumentParser(
+        description="Run commands on vms that were created using bootstrap-vm"
+    )
+    parser.add_argument("-c", "--config", help="config file to use")
+    parser.add_argument("--name", help="run on vms with a name matching this pattern")
+    parser.add_argument("--label", help="run on vms with this label")
+    parser.add_argument(
+        "-f", "--steps", help="yaml file with a list of commands to run in order"
+    )
+    parser.add_argument("--user", help="user to log in as")
+    parser.add_argument(
+        "-j",
+        "--parallel",
+        type=int,
+        default=32,
+        help="number of vms to run commands on at the same time",
+    )
+    parser.add_argument("command", nargs="*", help="commands to run in order")
+
+    args = vars(parser.parse_args())
+
+    if args["config"]:
+        config = Config(args["config"])
+    else:
+        config = Config(default_config_file())
+
+    if not args["name"] and not args["label"]:
+        parser.error("select vms with --name or --label (use --name '*' for all)")
+
+    steps = list(args["command"])
+    if args["steps"]:
+        try:
+            steps += read_steps(args["steps"])
+        except (OSError, RuntimeError, yaml.YAMLError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    if not steps:
+        parser.error("no commands given")
+
+    records = Inventory(config.inventory).find(
+        pattern=args["name"], label=args["label"]
+    )
+    if not records:
+        print("No vms found", file=sys.stderr)
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory(prefix="run-vm-") as control_dir:
+        hosts = [Host(record, args["user"], control_dir, config) for record in records]
+        loop = asyncio.new_event_loop()
+        # Child processes can only be watched from the loop of the main thread
+        asyncio.set_event_loop(loop)
+        main = loop.create_task(run_all(hosts, steps, args["parallel"]))
+        try:
+            loop.run_until_complete(main)
+        except BaseException:
+            # Cancel the hosts so they stop their master connections, and stop the
+            # ones that are left in case that is interrupted as well
+            try:
+                main.cancel()
+                loop.run_until_complete(asyncio.gather(main, return_exceptions=True))
+            finally:
+                for host in hosts:
+                    host.stop_master()
+            raise
+        finally:
+            loop.close()
+
+    print()
+    failed = 0
+    for host in hosts:
+        if host.error:
+            failed += 1
+            result = f"failed: {host.error}"
+        elif host.status == 0:
+            result = "ok"
+        else:
+            failed += 1
+            result = f"failed with exit status {host.status} in step {host.failed_step}"
+            if host.failed_step != "connect":
+                result += f": {shlex.quote(steps[host.failed_step - 1])}"
+        print(f"{host.name:<24} {result}")
+    print(f"{len(hosts) - failed} ok, {failed} failed")
+    if failed:
+        sys.exit(1)
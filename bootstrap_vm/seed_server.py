@@ -0,0 +1,148 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import subprocess
+import sys
+from functools import partial
+from http.server import BaseHTTPRequestHandler
+
+from bootstrap_vm import metrics
+from bootstrap_vm.config import Config, default_config_file
+from bootstrap_vm.distributions import get_distribution
+from bootstrap_vm.inventory import Inventory
+from bootstrap_vm.prefetch import start_prefetcher
+from bootstrap_vm.server import ThreadingHTTPServer
+from bootstrap_vm.virtual_machine import VirtualMachine
+
+
+def virtual_machine(record, config):
+    """Recreate the VirtualMachine of an inventory record to render its seed"""
+    seed = json.loads(record["seed"] or "{}")
+    return VirtualMachine(
+        name=record["name"],
+        distribution=get_distribution(
+            record["distribution"], record["variant"], config
+        ),
+        config=config,
+        macaddress=record["macaddress"],
+        public_keys=seed.get("public_keys"),
+        host_keys=seed.get("host_keys"),
+        netplan=seed.get("netplan"),
+    )
+
+
+def lease_addresses(macaddress):
+    """The addresses the default libvirt network handed out to this mac address"""
+    out = subprocess.run(
+        ["virsh", "net-dhcp-leases", "default", "--mac", macaddress],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    addresses = set()
+    for line in str(out.stdout, encoding="utf-8").split("\n")[2:]:
+        words = line.split()
+        if len(words) >= 5 and words[2].lower() == macaddress.lower():
+            addresses.add(words[4].split("/")[0])
+    return addresses
+
+
+class SeedHandler(BaseHTTPRequestHandler):
+    """
+    Serves the nocloud-net datasource for every vm in the inventory at
+    /<name or mac address>/meta-data (and user-data, vendor-data, network-config)
+
+    The seed contains the ssh host keys of the vm, so it is only served to the vm
+    itself: the client address has to be the address of the vm in the inventory or
+    the address its mac address got from DHCP.
+    """
+
+    def __init__(self, *args, config, **kwargs):
+        self.config = config
+        self.inventory = Inventory(config.inventory)
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2:
+            self.send_error(404)
+            return
+        key, filename = parts
+        record = self.inventory.lookup(key)
+        if record is None:
+            self.send_error(404, f"Unknown vm {key}")
+            return
+        if not self.is_vm(record):
+            self.send_error(403, f"Only {record['name']} can read its seed")
+            return
+
+        vm = virtual_machine(record, self.config)
+        files = {
+            "meta-data": vm.meta_data,
+            "user-data": vm.user_data,
+            "vendor-data": lambda: "",
+            "network-config": vm.network_config,
+        }
+        content = files[filename]() if filename in files else None
+        if content is None:
+            self.send_error(404)
+            return
+
+        metrics.seed_requests.inc(file=filename)
+        body = bytes(content, encoding="utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def is_vm(self, record):
+        client = self.client_address[0]
+        if record["ip"] and client == record["ip"]:
+            return True
+        return bool(record["macaddress"]) and client in lease_addresses(
+            record["macaddress"]
+        )
+
+
+def seed_vm():
+    parser = argparse.ArgumentParser(
+        description="Serve cloud-init seed data to vms created with --seed http"
+    )
+    parser.add_argument("-c", "--config", help="config file to use")
+    parser.add_argument("--address", help="address to listen on")
+    parser.add_argument("--port", type=int, help="port to listen on")
+
+    args = vars(parser.parse_args())
+
+    if args["config"]:
+        config = Config(args["config"])
+    else:
+        config = Config(default_config_file())
+
+    address = (args["address"] or config.seed_address, args["port"] or config.seed_port)
+    try:
+        server = ThreadingHTTPServer(address, partial(SeedHandler, config=config))
+    except OSError as e:
+        print(f"Could not listen on {address[0]}:{address[1]}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    metrics.serve(config)
+    start_prefetcher(config)
+    print(f"Serving cloud-init seed data on {address[0]}:{address[1]}")
+    server.serve_forever()
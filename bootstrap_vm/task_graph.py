@@ -0,0 +1,224 @@
+#  bootstrap-vm - Bootstrap a VM using libvirt tools
+#  Copyright (C) 2019 Jelle Besseling <jelle@pingiun.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import shutil
+import threading
+import time
+
+
+class Cancelled(Exception):
+    """Raised in stages that notice the graph is being torn down"""
+
+
+class Stage:
+    def __init__(self, name, func, requires):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.start = None
+        self.end = None
+        self.disk_usage = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class DiskMonitor:
+    """
+    Sample the used space of the filesystem that contains path in the background,
+    to find how much it grew while every stage ran. This is the usage of the whole
+    filesystem, so it includes the writes of stages that ran at the same time.
+    """
+
+    def __init__(self, path, interval=0.2):
+        self.path = path
+        self.interval = interval
+        self.samples = []
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        self.samples.append((time.monotonic(), shutil.disk_usage(self.path).used))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.sample()
+
+    def peak(self, start, end):
+        """The highest usage between start and end, relative to the usage at start"""
+        before = [used for at, used in self.samples if at <= start]
+        baseline = before[-1] if before else self.samples[0][1]
+        during = [used for at, used in self.samples if start <= at <= end]
+        return max([baseline, *during]) - baseline
+
+
+class TaskGraph:
+    """
+    Run blocking stages in threads, starting each stage as soon as all the
+    stages it requires are finished. With a disk_path, the peak growth of the
+    used space on that filesystem while every stage ran is measured as well.
+
+    When a stage fails or the run is interrupted, the graph is cancelled: stages
+    that wait or retry should sleep with TaskGraph.sleep, which raises Cancelled.
+    """
+
+    # How long a cancelled run waits for the running stages to stop
+    CANCEL_TIMEOUT = 2
+
+    def __init__(self, disk_path=None):
+        self.stages = {}
+        self.results = {}
+        self.start = None
+        self.end = None
+        self.monitor = DiskMonitor(disk_path) if disk_path else None
+        self.cancelled = threading.Event()
+        self._threads = []
+
+    def sleep(self, seconds):
+        if self.cancelled.wait(seconds):
+            raise Cancelled()
+
+    def add(self, name, func, requires=()):
+        if name in self.stages:
+            raise ValueError(f"There already is a stage named {name}")
+        for required in requires:
+            if required not in self.stages:
+                raise ValueError(f"Stage {name} requires unknown stage {required}")
+        self.stages[name] = Stage(name, func, requires)
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        if self.monitor:
+            self.monitor.start()
+        try:
+            self.start = time.monotonic()
+            loop.run_until_complete(self._run(loop))
+        except BaseException:
+            # Stages are blocking functions that cannot be interrupted, give the
+            # ones that check for cancellation some time to stop, but never wait
+            # for stages that might not finish (the threads are daemon threads)
+            self.cancelled.set()
+            deadline = time.monotonic() + self.CANCEL_TIMEOUT
+            for thread in self._threads:
+                thread.join(max(deadline - time.monotonic(), 0))
+            raise
+        finally:
+            self.end = time.monotonic()
+            loop.close()
+            if self.monitor:
+                self.monitor.stop()
+                for stage in self.stages.values():
+                    if stage.end is not None:
+                        stage.disk_usage = self.monitor.peak(stage.start, stage.end)
+        return self.results
+
+    async def _run(self, loop):
+        tasks = {}
+        for stage in self.stages.values():
+            requires = [tasks[required] for required in stage.requires]
+            tasks[stage.name] = loop.create_task(self._run_stage(loop, stage, requires))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+    def _start_thread(self, loop, stage):
+        future = loop.create_future()
+
+        def set_result(result, exception):
+            if future.cancelled():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+        def target():
+            result, exception = None, None
+            try:
+                result = stage.func()
+            except BaseException as e:
+                exception = e
+            try:
+                loop.call_soon_threadsafe(set_result, result, exception)
+            except RuntimeError:
+                # The loop is closed, the graph was torn down
+                pass
+
+        thread = threading.Thread(target=target, name=stage.name, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+        return future
+
+    async def _run_stage(self, loop, stage, requires):
+        if requires:
+            await asyncio.gather(*requires)
+        if self.monitor:
+            self.monitor.sample()
+        stage.start = time.monotonic()
+        self.results[stage.name] = await self._start_thread(loop, stage)
+        stage.end = time.monotonic()
+        if self.monitor:
+            self.monitor.sample()
+
+    def critical_path(self):
+        """
+        Returns the chain of finished stages that determined the total run time,
+        found by following the last finished requirement back from the last stage.
+        """
+        finished = [stage for stage in self.stages.values() if stage.end is not None]
+        stage = max(finished, key=lambda s: s.end, default=None)
+        path = []
+        while stage is not None:
+            path.append(stage)
+            stage = max(
+                (self.stages[required] for required in stage.requires),
+                key=lambda s: s.end,
+                default=None,
+            )
+        return list(reversed(path))
+
+    def print_critical_path(self):
+        path = self.critical_path()
+        if not path:
+            return
+        print(f"Finished in {self.end - self.start:.1f}s, critical path:")
+        for stage in path:
+            print(f"  {stage.name:<16} {stage.duration:6.1f}s")
+
+    def print_disk_usage(self):
+        stages = [stage for stage in self.stages.values() if stage.disk_usage]
+        if not stages:
+            return
+        print("Peak disk usage while the stage ran (including concurrent stages):")
+        for stage in stages:
+            print(f"  {stage.name:<16} {stage.disk_usage / 2 ** 20:8.1f}MiB")
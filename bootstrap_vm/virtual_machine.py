@@ -14,19 +14,34 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import io
 import os
 import subprocess
 import uuid
 
 from bootstrap_vm.config import Config
-from bootstrap_vm.constants import STATIC_INTERFACE, DHCP_INTERFACE, VM_XML
+from bootstrap_vm.constants import (
+    STATIC_INTERFACE,
+    DHCP_INTERFACE,
+    VM_XML,
+    ISO_SEED,
+    MEMBALLOON,
+    SMBIOS_SEED,
+)
 
 
 class VirtualMachine:
-    def __init__(self, name: str, distribution, config: Config, **kwargs: dict):
+    def __init__(
+        self,
+        name: str,
+        distribution,
+        config: Config,
+        macaddress: str = None,
+        **kwargs: dict,
+    ):
         self.name = name
         self.distribution = distribution
-        self.macaddress = "52:54:00:" + ":".join(
+        self.macaddress = macaddress or "52:54:00:" + ":".join(
             "{:02x}".format(byte) for byte in os.urandom(3)
         )
         self.config = config
@@ -34,10 +49,7 @@ class VirtualMachine:
 
     @property
     def image_location(self):
-        return os.path.join(
-            self.config.images_path,
-            f"{self.distribution.distribution}-{self.distribution.variant}.img",
-        )
+        return self.distribution.cache_location(self.config.images_path)
 
     @property
     def disk_location(self):
@@ -64,54 +76,65 @@ class VirtualMachine:
                     f.write("    " + line)
             f.write("\n")
 
+    def meta_data(self):
+        # we use the metadata to set up the authorized keys using the authorized keys
+        # from the home directory, and the public key from the root user
+        f = io.StringIO()
+        f.write(f"instance-id: {self.name}\n")
+        f.write(f"local-hostname: {self.name}\n")
+        f.write(f"public-keys:\n")
+        authorized_keys = os.path.join(
+            os.path.expanduser("~"), ".ssh", "authorized_keys"
+        )
+        if os.path.isfile(authorized_keys):
+            with open(authorized_keys) as keys:
+                for line in keys:
+                    f.write("  - " + line)
+        root_key = "/root/.ssh/id_ed25519.pub"
+        if os.path.isfile(root_key):
+            with open(root_key) as key:
+                f.write("  - " + key.read().strip() + "\n")
+        if self.args["public_keys"]:
+            for key in self.args["public_keys"]:
+                for line in key.split("\n"):
+                    if line.strip() != "":
+                        f.write("  - " + line.strip() + "\n")
+        return f.getvalue()
+
+    def user_data(self):
+        # The user data may be empty, but it has to exist
+        f = io.StringIO()
+        if self.args["host_keys"]:
+            f.write("#cloud-config\n\n")
+            f.write("ssh_keys:\n")
+            for keytype in ["ed25519", "rsa", "ecdsa"]:
+                self.write_ssh_key(f, self.args["host_keys"], keytype)
+        return f.getvalue()
+
+    def network_config(self):
+        if not self.args["netplan"]:
+            return None
+        with open(self.args["netplan"]) as netplan:
+            return netplan.read().format(macaddress=self.macaddress)
+
     def generate_iso(self):
         # cloud-init from the ubuntu cloud image uses a cdrom with metadata information
-        # we use this to set up the authorized keys using the authorized keys from the home
-        # directory, and the public key from the root user
         os.makedirs(self.config.iso_path, mode=0o0711, exist_ok=True)
+        if self.args["host_keys"]:
+            print(f"Placing host-keys from {self.args['host_keys']}")
         iso_files = list()
-        metadata_location = os.path.join(self.config.iso_path, "meta-data")
-        iso_files.append(metadata_location)
-        with open(metadata_location, "w") as f:
-            f.write(f"local-hostname: {self.name}\n")
-            f.write(f"public-keys:\n")
-            authorized_keys = os.path.join(
-                os.path.expanduser("~"), ".ssh", "authorized_keys"
-            )
-            if os.path.isfile(authorized_keys):
-                with open(authorized_keys) as keys:
-                    for line in keys:
-                        f.write("  - " + line)
-            root_key = "/root/.ssh/id_ed25519.pub"
-            if os.path.isfile(root_key):
-                with open(root_key) as key:
-                    f.write("  - " + key.read().strip() + "\n")
-            if self.args["public_keys"]:
-                for key in self.args["public_keys"]:
-                    for line in key.split("\n"):
-                        if line.strip() != "":
-                            f.write("  - " + line.strip() + "\n")
-
-        # This file only needs to be touched
-        userdata_location = os.path.join(self.config.iso_path, "user-data")
-        iso_files.append(userdata_location)
-        with open(userdata_location, "w") as f:
-            if self.args["host_keys"]:
-                print(f"Placing host-keys from {self.args['host_keys']}")
-                f.write("#cloud-config\n\n")
-                f.write("ssh_keys:\n")
-                for keytype in ["ed25519", "rsa", "ecdsa"]:
-                    self.write_ssh_key(f, self.args["host_keys"], keytype)
-
-        if self.args["netplan"]:
-            network_config_location = os.path.join(
-                self.config.iso_path, "network-config"
-            )
-            iso_files.append(network_config_location)
-            with open(network_config_location, "w") as f, open(
-                self.args["netplan"]
-            ) as netplan:
-                f.write(netplan.read().format(macaddress=self.macaddress))
+        seed = [
+            ("meta-data", self.meta_data()),
+            ("user-data", self.user_data()),
+            ("network-config", self.network_config()),
+        ]
+        for filename, content in seed:
+            if content is None:
+                continue
+            location = os.path.join(self.config.iso_path, filename)
+            iso_files.append(location)
+            with open(location, "w") as f:
+                f.write(content)
 
         subprocess.run(
             [
@@ -137,14 +160,33 @@ class VirtualMachine:
             )
         else:
             interface = DHCP_INTERFACE.format(macaddress=self.macaddress)
+        if self.args.get("seed") == "http":
+            # cloud-init reads the nocloud-net datasource url from the SMBIOS serial
+            seed_url = f"{self.config.seed_url.rstrip('/')}/{self.name}/"
+            seed = ""
+            sysinfo = SMBIOS_SEED.format(seed_url=seed_url)
+            smbios = '<smbios mode="sysinfo"/>'
+        else:
+            seed = ISO_SEED.format(iso_location=self.iso_location)
+            sysinfo = ""
+            smbios = ""
+        current_memory = self.args["memory"]
+        memballoon = ""
+        if self.args.get("density"):
+            current_memory = self.args.get("current_memory") or current_memory
+            memballoon = MEMBALLOON
         vm_def = VM_XML.format(
             name=self.name,
             uuid=vm_uuid,
             memory=self.args["memory"],
+            current_memory=current_memory,
+            memballoon=memballoon,
             vcpu=self.args["vcpu"],
             disk_location=self.disk_location,
-            iso_location=self.iso_location,
-            osid=self.distribution.urls[self.distribution.variant]["libosinfo_id"],
+            seed=seed,
+            sysinfo=sysinfo,
+            smbios=smbios,
+            osid=self.distribution.libosinfo_id,
             interface=interface,
         )
         print(vm_def)
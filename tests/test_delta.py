@@ -0,0 +1,137 @@
+import json
+import os
+import random
+import re
+from functools import partial
+from http.server import SimpleHTTPRequestHandler
+
+import pytest
+
+from bootstrap_vm.delta import DeltaUnavailable, delta_download, make_block_map
+from bootstrap_vm.server import serve_in_background
+
+BLOCK_SIZE = 4096
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Serves a directory, with support for single byte ranges"""
+
+    ranges = True
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        requested = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if not self.ranges or not requested or not os.path.isfile(path):
+            return super().do_GET()
+        start, end = int(requested.group(1)), int(requested.group(2))
+        with open(path, "rb") as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header(
+            "Content-Range", f"bytes {start}-{end}/{os.path.getsize(path)}"
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle(self):
+        # The client closes the connection when it gets the full file instead
+        try:
+            super().handle()
+        except ConnectionError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NoRangeHandler(RangeHandler):
+    ranges = False
+
+
+def start_server(handler, directory):
+    server = serve_in_background(
+        partial(handler, directory=str(directory)), ("127.0.0.1", 0)
+    )
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+@pytest.fixture
+def publish(tmp_path):
+    """Publish a new image with its block map, returns the urls"""
+    directory = tmp_path / "mirror"
+    directory.mkdir()
+    servers = []
+
+    def publish(data, handler=RangeHandler):
+        (directory / "image.img").write_bytes(data)
+        block_map = make_block_map(str(directory / "image.img"), BLOCK_SIZE)
+        (directory / "image.img.blockmap").write_text(json.dumps(block_map))
+        server, url = start_server(handler, directory)
+        servers.append(server)
+        return f"{url}/image.img", f"{url}/image.img.blockmap"
+
+    yield publish
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def old_image():
+    rng = random.Random(31)
+    return bytes(rng.getrandbits(8) for _ in range(64 * BLOCK_SIZE))
+
+
+def rebuild(tmp_path, old, url, block_map_url, rolling):
+    seed = tmp_path / "seed.img"
+    seed.write_bytes(old)
+    output = tmp_path / "output.img"
+    fetched, reused = delta_download(
+        url, block_map_url, str(seed), str(output), rolling
+    )
+    return output.read_bytes(), fetched, reused
+
+
+@pytest.mark.parametrize("rolling", [False, True])
+def test_in_place_edit(tmp_path, publish, old_image, rolling):
+    new = bytearray(old_image)
+    new[10 * BLOCK_SIZE + 7] ^= 0xFF
+    new[40 * BLOCK_SIZE : 40 * BLOCK_SIZE + 100] = bytes(100)
+    new = bytes(new)
+    data, fetched, reused = rebuild(tmp_path, old_image, *publish(new), rolling)
+    assert data == new
+    assert fetched == 2 * BLOCK_SIZE
+    assert reused == len(new) - fetched
+
+
+def test_shifted_data_without_rolling(tmp_path, publish, old_image):
+    new = old_image[:5000] + b"inserted" * 16 + old_image[5000:]
+    data, fetched, reused = rebuild(tmp_path, old_image, *publish(new), False)
+    assert data == new
+    # Only the first block is still at the same offset
+    assert reused == BLOCK_SIZE
+
+
+def test_shifted_data_with_rolling(tmp_path, publish, old_image):
+    new = old_image[:5000] + b"inserted" * 16 + old_image[5000:]
+    data, fetched, reused = rebuild(tmp_path, old_image, *publish(new), True)
+    assert data == new
+    # The block with the insertion, the block after it that straddles the old
+    # block boundary and the short last block are fetched
+    assert fetched <= 3 * BLOCK_SIZE
+    assert reused >= len(new) - 3 * BLOCK_SIZE
+
+
+def test_server_without_range_support(tmp_path, publish, old_image):
+    new = bytearray(old_image)
+    new[0] ^= 0xFF
+    with pytest.raises(DeltaUnavailable):
+        rebuild(tmp_path, old_image, *publish(bytes(new), NoRangeHandler), False)
+
+
+def test_missing_block_map(tmp_path, publish, old_image):
+    url, block_map_url = publish(old_image)
+    with pytest.raises(DeltaUnavailable):
+        rebuild(tmp_path, old_image, url, block_map_url + ".missing", False)
@@ -0,0 +1,166 @@
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from bootstrap_vm import density
+from bootstrap_vm.config import Config
+from bootstrap_vm.density import KSM, memory_stats, parse_key_values
+from bootstrap_vm.distributions import get_distribution
+from bootstrap_vm.virtual_machine import VirtualMachine
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+
+@pytest.fixture
+def config(tmp_path):
+    # A config file that does not exist gives the default config
+    return Config(str(tmp_path / "config.yaml"))
+
+
+@pytest.fixture
+def domain_xml(config, tmp_path, capsys):
+    def generate(**args):
+        vm = VirtualMachine(
+            "ci-1",
+            get_distribution("ubuntu", "focal", config),
+            config,
+            macaddress="52:54:00:12:34:56",
+            bridge=None,
+            seed="iso",
+            vcpu=1,
+            memory=1048576,
+            **args,
+        )
+        vm.generate_xml(str(tmp_path / "ci-1.xml"))
+        capsys.readouterr()
+        return ET.parse(str(tmp_path / "ci-1.xml")).getroot()
+
+    return generate
+
+
+@pytest.fixture
+def ksm_root(tmp_path):
+    root = tmp_path / "ksm"
+    root.mkdir()
+    for name, value in {
+        "run": 0,
+        "pages_to_scan": 100,
+        "sleep_millisecs": 20,
+        "pages_shared": 250,
+        "pages_sharing": 1000,
+        "pages_unshared": 40,
+        "pages_volatile": 7,
+    }.items():
+        (root / name).write_text(f"{value}\n")
+    return root
+
+
+def test_xml_without_density(domain_xml):
+    domain = domain_xml()
+    assert domain.find("memory").text == "1048576"
+    assert domain.find("currentMemory").text == "1048576"
+    assert domain.find("devices/memballoon") is None
+
+
+def test_xml_with_density(domain_xml):
+    domain = domain_xml(density=True, current_memory=524288)
+    assert domain.find("memory").text == "1048576"
+    assert domain.find("currentMemory").text == "524288"
+    balloon = domain.find("devices/memballoon")
+    assert balloon.attrib == {
+        "model": "virtio",
+        "autodeflate": "on",
+        "freePageReporting": "on",
+    }
+    assert balloon.find("stats").get("period") == "10"
+
+
+def test_xml_with_density_without_current_memory(domain_xml):
+    domain = domain_xml(density=True, current_memory=None)
+    assert domain.find("currentMemory").text == "1048576"
+    assert domain.find("devices/memballoon") is not None
+
+
+def test_xml_current_memory_needs_density(domain_xml):
+    domain = domain_xml(density=False, current_memory=524288)
+    assert domain.find("currentMemory").text == "1048576"
+
+
+def test_ksm_configure_writes_changed_settings(ksm_root):
+    ksm = KSM(str(ksm_root))
+    changed = ksm.configure({"run": 1, "pages_to_scan": 1000, "sleep_millisecs": 20})
+    assert changed == {"run": 1, "pages_to_scan": 1000}
+    assert (ksm_root / "run").read_text() == "1\n"
+    assert (ksm_root / "pages_to_scan").read_text() == "1000\n"
+    assert ksm.configure({"run": 1, "pages_to_scan": 1000}) == {}
+
+
+def test_ksm_stats(ksm_root):
+    ksm = KSM(str(ksm_root))
+    assert ksm.available()
+    assert ksm.stats() == {
+        "pages_shared": 250,
+        "pages_sharing": 1000,
+        "pages_unshared": 40,
+        "pages_volatile": 7,
+    }
+
+
+def test_ksm_stats_skips_missing_files(ksm_root):
+    (ksm_root / "pages_volatile").unlink()
+    assert "pages_volatile" not in KSM(str(ksm_root)).stats()
+
+
+def test_ksm_saved_bytes(ksm_root):
+    assert KSM(str(ksm_root)).saved_bytes() == 1000 * os.sysconf("SC_PAGE_SIZE")
+
+
+def test_ksm_not_available(tmp_path):
+    assert not KSM(str(tmp_path / "missing")).available()
+
+
+def test_parse_dommemstat():
+    stats = parse_key_values(fixture("dommemstat.txt"))
+    assert stats["actual"] == 524288
+    assert stats["rss"] == 312588
+    assert stats["unused"] == 301536
+
+
+def test_parse_dominfo():
+    info = parse_key_values(fixture("dominfo.txt"))
+    assert info["max memory"] == 1048576
+    assert info["used memory"] == 524288
+    assert info["id"] == 3
+    # Values that are not a number are skipped
+    assert "cpu time" not in info
+    assert "state" not in info
+
+
+def test_memory_stats(monkeypatch):
+    outputs = {"dommemstat": "dommemstat.txt", "dominfo": "dominfo.txt"}
+
+    def run(command, **kwargs):
+        stdout = bytes(fixture(outputs[command[1]]), encoding="utf-8")
+        return subprocess.CompletedProcess(command, 0, stdout=stdout)
+
+    monkeypatch.setattr(density.subprocess, "run", run)
+    assert memory_stats("ci-1") == {
+        "maximum": 1048576,
+        "actual": 524288,
+        "rss": 312588,
+    }
+
+
+def test_memory_stats_of_stopped_domain(monkeypatch):
+    def run(command, **kwargs):
+        return subprocess.CompletedProcess(command, 1, stdout=b"")
+
+    monkeypatch.setattr(density.subprocess, "run", run)
+    assert memory_stats("ci-1") is None
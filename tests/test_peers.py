@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import urllib.error
+import urllib.request
+from functools import partial
+
+import pytest
+
+from bootstrap_vm import metrics
+from bootstrap_vm.config import Config
+from bootstrap_vm.distributions import Distribution
+from bootstrap_vm.peers import ImageHandler
+from bootstrap_vm.server import serve_in_background
+
+
+def make_config(tmp_path, name):
+    images_path = tmp_path / name
+    images_path.mkdir()
+    path = tmp_path / f"{name}.yaml"
+    path.write_text(f"images_path: {images_path}\n")
+    return Config(str(path))
+
+
+@pytest.fixture
+def image():
+    return os.urandom(256 * 1024)
+
+
+@pytest.fixture
+def peers(tmp_path, image):
+    """Two share-vm instances, only the second one has the focal image"""
+    servers = {}
+    for name in ["empty", "full"]:
+        config = make_config(tmp_path, name)
+        if name == "full":
+            distribution = Distribution("ubuntu", "focal", config)
+            location = distribution.cache_location(config.images_path)
+            with open(location, "wb") as f:
+                f.write(image)
+            distribution.write_metadata(location, hashlib.sha256(image).hexdigest())
+        server = serve_in_background(
+            partial(ImageHandler, config=config), ("127.0.0.1", 0)
+        )
+        servers[name] = (server, f"http://127.0.0.1:{server.server_address[1]}")
+    yield {name: url for name, (server, url) in servers.items()}
+    for server, url in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+def get(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, dict(response.headers), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers), None
+
+
+def test_listing(peers, image):
+    status, headers, body = get(peers["full"] + "/images")
+    assert status == 200
+    assert json.loads(body) == [
+        {
+            "name": "Ubuntu-focal",
+            "checksum_type": "sha256",
+            "checksum": hashlib.sha256(image).hexdigest(),
+            "size": len(image),
+        }
+    ]
+    assert json.loads(get(peers["empty"] + "/images")[2]) == []
+
+
+def test_image(peers, image):
+    checksum = hashlib.sha256(image).hexdigest()
+    status, headers, body = get(f"{peers['full']}/images/{checksum}")
+    assert status == 200
+    assert body == image
+    assert get(f"{peers['empty']}/images/{checksum}")[0] == 404
+    assert get(f"{peers['full']}/images/{'0' * 64}")[0] == 404
+
+
+def test_range(peers, image):
+    url = f"{peers['full']}/images/{hashlib.sha256(image).hexdigest()}"
+    status, headers, body = get(url, {"Range": "bytes=1000-1999"})
+    assert status == 206
+    assert headers["Content-Range"] == f"bytes 1000-1999/{len(image)}"
+    assert body == image[1000:2000]
+
+    status, headers, body = get(url, {"Range": "bytes=200000-"})
+    assert status == 206
+    assert body == image[200000:]
+
+    status, headers, body = get(url, {"Range": f"bytes={len(image)}-"})
+    assert status == 416
+    assert headers["Content-Range"] == f"bytes */{len(image)}"
+
+
+def test_download_falls_through_to_a_peer_that_has_the_image(tmp_path, peers, image):
+    config = make_config(tmp_path, "client")
+    distribution = Distribution("ubuntu", "focal", config)
+    checksum = hashlib.sha256(image).hexdigest()
+    hits = dict(metrics.peer_downloads.samples()).get(
+        'bootstrap_vm_peer_downloads_total{result="hit"}', 0
+    )
+    download_location = distribution.download(
+        distribution.cache_location(config.images_path),
+        peers=[peers["empty"], peers["full"]],
+        checksum=checksum,
+    )
+    with open(download_location, "rb") as f:
+        assert f.read() == image
+    assert (
+        dict(metrics.peer_downloads.samples())[
+            'bootstrap_vm_peer_downloads_total{result="hit"}'
+        ]
+        == hits + 1
+    )
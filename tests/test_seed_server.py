@@ -0,0 +1,111 @@
+import urllib.error
+import urllib.request
+from functools import partial
+
+import pytest
+
+from bootstrap_vm import seed_server
+from bootstrap_vm.config import Config
+from bootstrap_vm.distributions import get_distribution
+from bootstrap_vm.inventory import Inventory
+from bootstrap_vm.server import serve_in_background
+from bootstrap_vm.virtual_machine import VirtualMachine
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "config.yaml"
+    path.write_text(f"inventory: {tmp_path / 'inventory.db'}\n")
+    return Config(str(path))
+
+
+@pytest.fixture
+def add_vm(config, tmp_path):
+    host_keys = tmp_path / "host-keys"
+    host_keys.mkdir()
+    (host_keys / "ssh_host_ed25519_key").write_text("PRIVATE KEY\n")
+
+    def add(name, macaddress, ip=None):
+        vm = VirtualMachine(
+            name,
+            get_distribution("ubuntu", "focal", config),
+            config,
+            macaddress=macaddress,
+            ip=ip,
+            public_keys=[],
+            host_keys=str(host_keys),
+            netplan=None,
+        )
+        Inventory(config.inventory).add(vm)
+
+    return add
+
+
+@pytest.fixture
+def leases(monkeypatch):
+    leases = {}
+    monkeypatch.setattr(
+        seed_server, "lease_addresses", lambda mac: leases.get(mac, set())
+    )
+    return leases
+
+
+@pytest.fixture
+def get(config):
+    server = serve_in_background(
+        partial(seed_server.SeedHandler, config=config), ("127.0.0.1", 0)
+    )
+    port = server.server_address[1]
+
+    def get(path):
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}") as r:
+                return r.status, r.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+    yield get
+    server.shutdown()
+    server.server_close()
+
+
+def test_serves_the_vm_with_its_inventory_ip(add_vm, leases, get):
+    add_vm("static", "52:54:00:00:00:01", ip="127.0.0.1")
+    status, body = get("/static/user-data")
+    assert status == 200
+    assert "PRIVATE KEY" in body
+
+
+def test_serves_the_vm_with_its_dhcp_lease(add_vm, leases, get):
+    add_vm("dhcp", "52:54:00:00:00:02")
+    leases["52:54:00:00:00:02"] = {"127.0.0.1"}
+    assert get("/52:54:00:00:00:02/user-data")[0] == 200
+    assert get("/dhcp/meta-data")[0] == 200
+
+
+def test_refuses_other_clients(add_vm, leases, get):
+    add_vm("other", "52:54:00:00:00:03", ip="192.168.122.50")
+    leases["52:54:00:00:00:03"] = {"192.168.122.50"}
+    assert get("/other/user-data") == (403, None)
+    assert get("/52:54:00:00:00:03/meta-data") == (403, None)
+
+
+def test_unknown_vm(leases, get):
+    assert get("/missing/user-data") == (404, None)
+
+
+def test_lease_addresses(monkeypatch):
+    output = (
+        b" Expiry Time           MAC address         Protocol   IP address"
+        b"           Hostname   Client ID or DUID\n"
+        b"-" * 60 + b"\n"
+        b" 2026-10-19 17:00:00   52:54:00:00:00:02   ipv4       192.168.122.7/24"
+        b"     dhcp       -\n\n"
+    )
+
+    def run(command, **kwargs):
+        assert command[-1] == "52:54:00:00:00:02"
+        return seed_server.subprocess.CompletedProcess(command, 0, stdout=output)
+
+    monkeypatch.setattr(seed_server.subprocess, "run", run)
+    assert seed_server.lease_addresses("52:54:00:00:00:02") == {"192.168.122.7"}